@@ -2,6 +2,7 @@
 # coding=utf-8
 
 import os
+import atexit
 import subprocess
 from tempfile import NamedTemporaryFile
 import string
@@ -10,7 +11,10 @@ import re
 import time
 import socket
 import shlex
+import threading
+import weakref
 
+# asyncio is imported only in the async functions, it would double the start-up time of the CLI
 import sys
 if sys.version_info < (3,10):
     import collections
@@ -18,6 +22,12 @@ else:
     import collections.abc as collections
 import fnmatch
 
+from qsubmit.fswatch import DirWatcher
+from qsubmit.accounting import ReportCache
+from qsubmit.discovery import ResourceCache, parse_mem
+from qsubmit.resultcache import ResultCache, spec_key
+from qsubmit import config
+
 
 """Interface for running any Python code as a job on the cluster
 (using the qsub/qstat/qacct commands).
@@ -25,7 +35,7 @@ import fnmatch
 Tested with Sun Grid Engine.
 """
 
-# TODO: allow .qsubmitrc to override this
+# the [location NAME] sections of .qsubmitrc are added below
 LOCATIONS = {
     'bwlf': {
         'engine': 'grun',
@@ -45,12 +55,30 @@ LOCATIONS = {
     }
 }
 
+CONFIG = config.load_config()
+for _loc, _params in config.config_locations(CONFIG).items():
+    LOCATIONS.setdefault(_loc, {}).update(_params)
+
 
 ENGINES = {
     'sge': {
-        'submit_cmd': 'qsub -cwd -j y -o "<LOGDIR><NAME>.o$JOB_ID"',
+        'submit_cmd': 'qsub -cwd -j y -o "<LOGDIR><NAME>.o$JOB_ID<LOG_TASK>"',
+        # job array tasks log into separate files (the task index is 'undefined' for single jobs)
+        'log_task': '.$TASK_ID',
+        # the job script is passed on stdin, no temporary file is needed
+        'script_stdin': True,
         'interactive_cmd': 'qrsh -now no -pty yes',
         'delete_cmd': 'qdel <JOB_ID>',
+        # job states of all jobs in the queue, fields: job ID, state, queue@host
+        'state_cmd': 'qstat',
+        'state_fields': (0, 4, 7),
+        # accounting reports: one job, or a scan of all finished jobs
+        'report_cmd': 'qacct -j <JOB_IDS>',
+        'report_scan_cmd': 'qacct -j',
+        'report_format': 'qacct',
+        # hosts with their queues, memory and GPU memory, see discovery.py
+        'resources_cmd': 'qhost -q -F gpu_ram',
+        'resources_format': 'qhost',
         'params': {
             'name': '-N "<NAME>"',
             'mem': '-l mem_free=<MEM>,act_mem_free=<MEM>,h_vmem=<MEM>',
@@ -58,6 +86,7 @@ ENGINES = {
             'queue': '-q <QUEUE>',
             'hold': '-hold_jid <HOLD>',
             'gpus': '-l gpu=<GPUS>,gpu_ram=<GPU_MEM>',
+            'array': '-t <ARRAY>',
         },
         'script': {
             'print_info': 'qstat -j <JOB_ID>',
@@ -66,11 +95,16 @@ ENGINES = {
             'maxvmem_cmd': 'qstat -j $JOB_ID | grep -e "^usage" | cut -f 5 -d, | cut -d = -f 2',
             'usage_cmd': 'qstat -j $JOB_ID | grep "^usage" | cut -b 29-',
             'load_profile_cmd': '[ -e /net/projects/SGE/user/sge_profile ] && . /net/projects/SGE/user/sge_profile',
+            # the variable is 'undefined' for single jobs
+            'task_id': '${SGE_TASK_ID/undefined/}',
         }
     },
     'grun': {
         'submit_cmd': 'grun -oe "<LOGDIR><NAME>.o%j" -nowait',
         'script_prepend': '/bin/bash',
+        # submitted with -nowait, the jobs are queried in the same way as on SGE
+        'state_cmd': 'qstat',
+        'state_fields': (0, 4, 7),
         'params': {
             'name': '-j "<NAME>"',
             'mem': '--mem=<MEM>',
@@ -84,19 +118,33 @@ ENGINES = {
             'maxvmem_cmd': 'echo "NOT IMPLEMENTED"',
             'usage_cmd': 'echo "NOT IMPLEMENTED"',
             'load_profile_cmd': '',
+            'task_id': '',
         }
     },
     'slurm': {
         'submit_cmd': 'sbatch -o <LOGDIR><NAME>.o%j',
+        'script_stdin': True,
         'interactive_cmd': 'srun --pty',
+        'delete_cmd': 'scancel <JOB_ID>',
+        'state_cmd': 'squeue -h -o "%i %t %P@%N" --jobs=<JOB_IDS>',
+        'state_fields': (0, 1, 2),
+        # the fields must match accounting.SACCT_FIELDS
+        'report_cmd': 'sacct -n -P -X -j <JOB_IDS> --format=JobID,JobName,State,ExitCode,NodeList,Start,End,Elapsed,MaxRSS',
+        'report_format': 'sacct',
+        # the fields must match discovery.SINFO_FIELDS
+        'resources_cmd': 'sinfo -h -N -o "%N|%P|%f|%m|%G"',
+        'resources_format': 'sinfo',
         'params': {
             'name': '-J <NAME>',
             'mem': '--mem=<MEM>',
             'cpus': '-c <CPUS>',
             'queue': '-p <QUEUE>',
             'hold': '-d afterany:<HOLD>',
+            # held until the dependencies succeed, never started if any of them fails
+            'hold_ok': '-d afterok:<HOLD>',
             # in gpu_mem variable, there should be either a space " ", or it should be like '--constraint="gpuram11G|gpuram24G"'
             'gpus': '--gres=gpu:<GPUS> <GPU_MEM>',
+            'array': '--array=<ARRAY>',
         },
         'script': {
             'print_info': 'echo "NOT IMPLEMENTED"',
@@ -106,10 +154,13 @@ ENGINES = {
             # credits to Dušan:
             'usage_cmd': 'sacct -n -j $SLURM_JOB_ID.batch --format=MaxVMSize,MaxVMSizeNode,MaxPages,ReqMem,AllocTRES | tr -s " " "," | sed \'s/^,//;s/,$//\'',
             'load_profile_cmd': '',
+            'task_id': '$SLURM_ARRAY_TASK_ID',
         }
     },
     'console': {
         'submit_cmd': 'bash',
+        # the job has finished when the submission returns
+        'synchronous': True,
         'params': {},
         'script': {
             'print_info': 'echo "NOT IMPLEMENTED"',
@@ -118,6 +169,7 @@ ENGINES = {
             'maxvmem_cmd': 'echo "NOT IMPLEMENTED"',
             'usage_cmd': 'echo "NOT IMPLEMENTED"',
             'load_profile_cmd': '',
+            'task_id': '',
         }
     }
 }
@@ -130,6 +182,10 @@ sdate=`date`  # start date
 # load UFAL SGE profile, if exists
 <LOAD_PROFILE_CMD>
 
+# job array task index and parameter (empty for single jobs)
+export QSUBMIT_TASK_ID=<TASK_ID>
+<TASK_PARAMS>
+
 hard=$(<RESOURCE_CMD>)
 
 echo "=============================="
@@ -161,8 +217,8 @@ echo "=============================="
 
 fdate=`date`
 
-# remove this temporary script
-rm <SCRIPT_TMPFILE>
+# remove this temporary script (there is none if it was submitted on stdin)
+rm -f <SCRIPT_TMPFILE>
 
 # print all we know about ourselves
 echo "Batch job information:"
@@ -185,24 +241,45 @@ echo "== Started:   $sdate"
 echo "== Finished:  $fdate     $exitinfo"
 echo "== Duration:  $duration"
 echo "=============================="
+
+# completion marker with the exit status, watched by Job.wait(); renamed into place,
+# so that it never appears empty (none if nobody is going to wait for the job)
+if [ -n "<DONE_FILE>" ]; then
+  echo $exitstatus > "<DONE_FILE>.tmp" && mv "<DONE_FILE>.tmp" "<DONE_FILE>"
+fi
 '''
 
 # default job header
 DEFAULT_CODE_TEMPLATE = """#!/usr/bin/env python3
 import os
 
+# job array task index and parameter (empty for single jobs)
+os.environ['QSUBMIT_TASK_ID'] = <TASK_ID>
+<TASK_PARAMS>
+
 def main():
 <CODE>
 
 if __name__ == '__main__':
     main()
-    os.remove('<CODE_TMPFILE>')
+    # the temporary script (there is none if it was submitted on stdin)
+    if '<CODE_TMPFILE>':
+        os.remove('<CODE_TMPFILE>')
+    # completion marker, watched by Job.wait(); renamed into place, so that it never appears empty
+    # (job array tasks write separate markers, named by the task index variable; none if nobody
+    # is going to wait for the job)
+    done_file = os.path.expandvars('<DONE_FILE>')
+    if done_file:
+        with open(done_file + '.tmp', 'w') as fh:
+            print(0, file=fh)
+        os.replace(done_file + '.tmp', done_file)
 """
 
-#  gpuram size constraints on ÚFAL cluster
-#  TODO: it should be automated to reflect changes on cluster automatically
-#  (and made effecitvely, possibly without this subprocess in every run)
-# sinfo -o "%N %f" | grep gpu | cut -f 2 -d' ' | cut -f 1 -d',' | sort -u
+# partitions and gpuram size constraints on ÚFAL cluster; the ones that exist
+# are discovered by sinfo (and cached, see RESOURCE_CACHE), these are used
+# when sinfo is not available
+UFAL_GPU_QUEUES = ["gpu-troja", "gpu-ms"]
+UFAL_CPU_QUEUES = ["cpu-troja", "cpu-ms"]
 UFAL_GPU_MEM_OPTIONS = """gpuram11G
 gpuram16G
 gpuram24G
@@ -211,10 +288,21 @@ gpuram48G""".split()
 
 
 def detect_location():
-    """Check for hostname patterns, if they correspond to any of the preset locations."""
+    """Return the location set in .qsubmitrc, or check for hostname patterns, if they
+    correspond to any of the preset locations. The detected location is cached per
+    host, as getfqdn() may take long (a DNS lookup)."""
+    location = config.configured_location(CONFIG)
+    if location:
+        if location not in LOCATIONS:
+            raise Exception('Unknown location %s in %s' % (location, config.config_path()))
+        return location
+    location = config.cached_location(LOCATIONS)
+    if location:
+        return location
     hostname = socket.getfqdn()
     for loc, params in LOCATIONS.items():
-        if re.search(params['hostname'], hostname):
+        if 'hostname' in params and re.search(params['hostname'], hostname):
+            config.cache_location(loc, LOCATIONS)
             return loc
     raise Exception('Qsubmit not configured to use at %s' % hostname)
 
@@ -243,7 +331,22 @@ class Job:
                  created and run (will be created on launch)
     dependencies-list of Jobs this job depends on (must be submitted
                  before submitting this job)
+    hold_ok   -- if True, the job is started only if all its dependencies
+                 have succeeded, on the engines that support it (the
+                 'hold_ok' param); otherwise once they have ended
     queue     -- queue setting for SGE
+    location  -- the location (see LOCATIONS), detected if no engine
+                 is given
+    array     -- job array task range (e.g. '1-100'), see submit_array()
+    cache     -- if True, the job is not queued when an identical job has
+                 succeeded before and its inputs and outputs have not
+                 changed since then (see RESULT_CACHE)
+    inputs    -- list of input files of the job (for the cache)
+    outputs   -- list of output files of the job (for the cache)
+    done_marker-if True (default), the job writes a completion marker
+                 to its work_dir for wait() and exit_status; set it to
+                 False for jobs that nobody waits for (their state is
+                 then only known from the batch engine)
 
     In addition, the following values may be queried for each job
     at runtime or later:
@@ -254,13 +357,19 @@ class Job:
     host      -- the machine where the job is running (short name)
     jobid     -- the numeric id of the job in the cluster (NB: type is
                  string!)
-    report    -- job report using the qacct command (dictionary,
+    task_jobids-ids of all the submitted jobs (more than one only for
+                 job arrays on engines that do not support them)
+    cached    -- True if the job was not queued, its cached result is
+                 up to date
+    report    -- job accounting report using sacct/qacct (dictionary,
                  available only after the job has finished)
     exit_status- numeric job exit status (if the job is finished)
     """
 
     # job state 'FINISHED' symbol
     FINISH = 'f'
+    # state of the jobs of engines that cannot be queried, until their completion marker appears
+    UNKNOWN = '?'
     # job name prefix
     NAME_PREFIX = 'qsubmit_'
     # job directory prefix
@@ -274,26 +383,35 @@ class Job:
     DEFAULT_GPU_MEM = '4g'
     # only 1 job status query per second
     TIME_QUERY_DELAY = 1
-    # job status polling delay for wait() in seconds
+    # job status polling delay for wait() in seconds: starts at the minimum,
+    # grows by the backoff factor up to the maximum as the job keeps running
+    TIME_POLL_MIN = 1
+    TIME_POLL_BACKOFF = 1.5
     TIME_POLL_DELAY = 60
+    # how often wait() checks for the completion marker (if inotify does not see it, e.g. on NFS)
+    TIME_MARKER_POLL = 1
+    # how many tasks of an emulated job array are submitted at once
+    ARRAY_SUBMIT_THREADS = 64
 
     def __init__(self, code=None, command=None,
                  name=None, work_dir=None, log_dir=None, dependencies=None,
                  mem=DEFAULT_MEMORY, cpus=DEFAULT_CPUS,
                  gpus=None, gpu_mem=DEFAULT_GPU_MEM,
-                 engine=None, location=None, queue=None,
-                 code_templ=DEFAULT_CODE_TEMPLATE, script_templ=DEFAULT_SCRIPT_TEMPLATE):
+                 engine=None, location=None, queue=None, array=None,
+                 code_templ=DEFAULT_CODE_TEMPLATE, script_templ=DEFAULT_SCRIPT_TEMPLATE,
+                 cache=False, inputs=None, outputs=None, done_marker=True):
         """Constructor. May provide some running options --
         the desired Python code to be run, the headers of the resulting
         script (default provided), the job name and working directory.
         All of these options can be set later via the corresponding
         attributes.
         """
-        if engine:
-            self.engine = ENGINES[engine]
-        else:
+        if not engine:
             location = location or detect_location()
-            self.engine = ENGINES[LOCATIONS[location]['engine']]
+            engine = LOCATIONS[location]['engine']
+        self.location = location
+        self.engine_name = engine
+        self.engine = ENGINES[engine]
         self.code = code
         self.command = command
         self.code_templ = code_templ
@@ -301,12 +419,19 @@ class Job:
         self.mem = mem
         self.cpus = cpus
         self.gpus = gpus
+        self.array = array
+        self.task_params = None
+        self.hold_ok = False
         self.queue, self.gpus, self.gpu_mem = self._parse_queue(location, queue, gpus, gpu_mem)
         self._jobid = None
+        self.task_jobids = []
+        self._submit_time = None
+        self._cluster = None
         self._host = None
         self._state = None
         self._report = None
-        self._state_last_query = time.time()
+        self.done_file = None
+        self._done_status = None
         self._dependencies = []
         if dependencies is not None:
             self.add_dependency(dependencies)
@@ -314,24 +439,176 @@ class Job:
         self.submitted = False
         self.work_dir = work_dir if work_dir is not None else os.getcwd()
         self.log_dir = log_dir
+        self.cache = cache
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.cached = False
+        self._cache_key = None
+        self.done_marker = done_marker
 
     def submit(self, print_cmd=None):
         """Submit the job to the cluster.
         All jobs on which this job is dependent must already be submitted!
         """
-        # create working directory if necessary
+        if self._use_cached_result():
+            return
+        self._prepare_submit()
+        task_ids = self._get_submitted_task_ids()
+        if len(task_ids) > 1:
+            # the tasks of an emulated job array are submitted concurrently, as the console
+            # engine runs each of them until it finishes
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(len(task_ids), self.ARRAY_SUBMIT_THREADS)) as pool:
+                self.task_jobids = list(pool.map(lambda task_id: self._submit_task(print_cmd, task_id), task_ids))
+        else:
+            self.task_jobids = [self._submit_task(print_cmd, task_ids[0])]
+        self._set_submitted()
+
+    def _submit_task(self, print_cmd, task_id):
+        """Run the submit command (for one task of an emulated job array), return the job ID."""
+        run_cmd, script_input = self._get_submit_cmd(print_cmd, task_id)
+        if self.code or self.command:
+            # the submit command runs in the working directory, no global chdir
+            output = subprocess.check_output(run_cmd, input=script_input, encoding='UTF-8', cwd=self.work_dir)
+            return self._parse_jobid(output)
+        subprocess.call(run_cmd, cwd=self.work_dir)
+        return None
+
+    async def submit_async(self, print_cmd=None):
+        """Asynchronous version of submit(), runs the submit command(s)
+        as asyncio subprocesses, so that many jobs may be submitted
+        concurrently from a single event loop.
+        """
+        import asyncio
+        if not (self.code or self.command):
+            raise RuntimeError('Interactive jobs cannot be submitted asynchronously')
+        if self._use_cached_result():
+            return
+        self._prepare_submit()
+        limit = asyncio.Semaphore(self.ARRAY_SUBMIT_THREADS)
+
+        async def submit_task(task_id):
+            run_cmd, script_input = self._get_submit_cmd(print_cmd, task_id)
+            async with limit:
+                proc = await asyncio.create_subprocess_exec(*run_cmd, cwd=self.work_dir,
+                                                            stdin=asyncio.subprocess.PIPE if script_input else None,
+                                                            stdout=asyncio.subprocess.PIPE)
+                output, _ = await proc.communicate(script_input.encode('UTF-8') if script_input else None)
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, run_cmd, output)
+            return self._parse_jobid(output.decode('UTF-8'))
+
+        # the tasks of an emulated job array are submitted concurrently
+        self.task_jobids = list(await asyncio.gather(*[submit_task(task_id)
+                                                       for task_id in self._get_submitted_task_ids()]))
+        self._set_submitted()
+
+    def _prepare_submit(self):
+        """Create the working directory if necessary and choose the completion marker file."""
         if not os.path.isdir(self.work_dir):
             os.mkdir(self.work_dir)
-        cwd = os.getcwd()
-        os.chdir(self.work_dir)
+        self._submit_time = time.time()
+        self._done_status = None
+        if not self.done_marker:
+            self.done_file = None
+            return
+        token = ''.join([random.choice(self.JOBNAME_LEGAL_CHARS) for _ in range(8)])
+        self.done_file = os.path.join(os.path.abspath(self.work_dir), f'.qsubmit-{self.name}-{token}.done')
+
+    def _use_cached_result(self):
+        """With the cache on, look for a result of this job in the RESULT_CACHE.
+        If it is up to date, mark the job as finished successfully without
+        queueing it and return True."""
+        if not self.cache or not (self.code or self.command):
+            return False
+        self._cache_key = spec_key(self._cache_spec())
+        # the inputs may still change if any of the dependencies is to be run
+        if any(not (isinstance(dep, Job) and dep.cached) for dep in self._dependencies):
+            return False
+        if not RESULT_CACHE.lookup(self._cache_key, self._cache_files()):
+            return False
+        self.cached = True
+        self.task_jobids = [None]
+        self._done_status = 0
+        self._set_submitted()
+        return True
+
+    def _cache_spec(self):
+        """Everything that makes the job's result, for the cache key."""
+        return {
+            'engine': self.engine_name,
+            'code': self.code,
+            'command': self.command,
+            'work_dir': os.path.abspath(self.work_dir),
+            'resources': {param: str(getattr(self, param, None)) for param in ('mem', 'cpus', 'gpus', 'gpu_mem', 'queue', 'array')},
+            'task_params': self.task_params,
+            'inputs': [self._cache_path(fn) for fn in self.inputs],
+            'outputs': [self._cache_path(fn) for fn in self.outputs],
+        }
 
+    def _cache_path(self, fn):
+        return os.path.normpath(os.path.join(os.path.abspath(self.work_dir), fn))
+
+    def _cache_files(self):
+        return [self._cache_path(fn) for fn in self.inputs + self.outputs]
+
+    def _store_result(self):
+        """Record the job's success in the RESULT_CACHE (once)."""
+        if self.cache and not self.cached and self._cache_key is not None:
+            RESULT_CACHE.store(self._cache_key, self._cache_files(), self.jobid)
+            self._cache_key = None
+
+    def _get_submitted_task_ids(self):
+        """Return the task indexes to be submitted separately ([None] if
+        there is only one submission)."""
+        if self.array and 'array' not in self.engine['params']:
+            # no job arrays in this engine, submit the tasks one by one
+            return self._get_array_task_ids()
+        return [None]
+
+    def _set_submitted(self):
+        """Mark the job as submitted and start tracking its state."""
+        self._jobid = self.task_jobids[0]
+        if self._jobid is not None:
+            STATE_TRACKER.watch(self)
+        self.submitted = True
+        if self.done_file is None or self.cached:
+            return
+        # the result is cached when the job succeeds, even if nobody waits for it here
+        if self.cache and self._cache_key is not None:
+            RESULT_CACHE.submitted(self._cache_key, self._get_done_files(), self.jobid)
+        else:
+            # removed at exit if they are not read by then
+            _UNREAD_MARKERS.update(self._get_done_files())
+
+    @staticmethod
+    def _parse_jobid(output):
+        return re.search('([0-9]+)', output).group(0)
+
+    def submit_array(self, tasks, print_cmd=None):
+        """Submit the job as a job array, i.e. with one scheduler call for
+        all the tasks. The tasks are given either as their number or as
+        a list of per-task parameters. The command may use the (1-based)
+        task index in $QSUBMIT_TASK_ID and the corresponding parameter
+        in $QSUBMIT_TASK_PARAM.
+        """
+        if isinstance(tasks, int):
+            self.task_params = None
+            num_tasks = tasks
+        else:
+            self.task_params = [str(task) for task in tasks]
+            num_tasks = len(self.task_params)
+        self.array = f'1-{num_tasks}'
+        self.submit(print_cmd)
+
+    def _get_submit_cmd(self, print_cmd, task_id=None):
+        """Create the job script and return the submit command, and the
+        script text if it is to be passed on the command's stdin (None
+        if it is written to a temporary file, given to the command)."""
         run_cmd = self.engine['submit_cmd']
-        # python code
-        if self.code:
-            script_file = self._get_code_script()
-        # any command
-        elif self.command:
-            script_file = self._get_command_script()
+        script_text, script_name = None, None
+        if self.code or self.command:
+            script_text, script_name = self._get_script(task_id)
         # interactive
         else:
             run_cmd = self.engine['interactive_cmd']
@@ -339,6 +616,8 @@ class Job:
         # get the engine params (replace job name + logdir in the main command)
         run_cmd = run_cmd.replace('<NAME>', self.name or 'qsubmit')
         run_cmd = run_cmd.replace('<LOGDIR>', (self.log_dir or '.') + '/')
+        # an emulated job array task is a single job for the engine
+        run_cmd = run_cmd.replace('<LOG_TASK>', self.engine.get('log_task', '') if self.array and task_id is None else '')
         run_cmd = shlex.split(run_cmd)
 
         # add resource requests and dependencies
@@ -346,41 +625,37 @@ class Job:
         run_cmd.extend(self._get_dependency_string())
 
         # add the scriptfile name, or login shell
-        if self.code or self.command:
+        if script_name:
             if 'script_prepend' in self.engine:
                 run_cmd.append(self.engine['script_prepend'])
-            run_cmd.append(script_file.name)
-        else:
+            run_cmd.append(script_name)
+        elif not (self.code or self.command):
             run_cmd.extend(['bash', '-l'])
 
         # submit the script
         self.submit_cmd = ' '.join([shlex.quote(t) for t in run_cmd])
         if print_cmd is not None:
             print(self.submit_cmd, file=print_cmd)
-        if self.code or self.command:
-            output = subprocess.check_output(run_cmd, encoding='UTF-8')
-            self._jobid = re.search('([0-9]+)', output).group(0)
-        else:
-            subprocess.call(run_cmd)
-
-        os.chdir(cwd)
-        self.submitted = True
+        return run_cmd, (script_text if not script_name else None)
 
     @property
     def state(self):
         """Retrieve information about current job state. Will also
         retrieve the host this job is running on and store it in
         the __host variable, if applicable.
+
+        The state is taken from the shared STATE_TRACKER, which queries
+        the batch engine for all watched jobs at once.
         """
         # job hasn't been submitted -- no point in retrieving state
         if not self.submitted:
             return None
-        # state caching
-        if time.time() < self._state_last_query + self.TIME_QUERY_DELAY:
-            return self._state
-        self._state_last_query = time.time()
-        # actually retrieve the state
-        state, host = self._get_job_state()
+        # interactive jobs are over once submit() returns
+        if self.jobid is None:
+            return self.FINISH
+        # the job is unfinished as long as any of its tasks is
+        states = [STATE_TRACKER.state(self.engine_name, jobid) for jobid in self.task_jobids]
+        state, host = next((s for s in states if s[0] != self.FINISH), states[0])
         self._state = state
         if state != self.FINISH:
             self._host = host
@@ -388,47 +663,139 @@ class Job:
 
     @property
     def report(self):
-        """Access to qacct report. Please note that running the qacct command
-        takes a few seconds, so the first access to the report is rather
-        slow.
+        """Access to the accounting report (sacct/qacct). The reports are
+        kept in the shared REPORT_CACHE (also on disk), and when a report
+        needs to be retrieved, reports of all the other finished jobs known
+        to the STATE_TRACKER are retrieved along in the same call.
         """
-        # no stats until the job has finished
-        if not self.submitted or self.state != self.FINISH:
+        # no stats until the job has finished (and none for interactive jobs)
+        if not self.submitted or self.jobid is None or self.state != self.FINISH:
             return None
         # the report is retrieved only once
         if self._report is None:
-            # try to retrieve the qacct report
-            output = subprocess.check_output(['qacct', '-j', self.jobid], encoding='UTF-8')
-            self._report = {}
-            for line in output.split("\n"):
-                if ' ' not in line:
-                    continue
-                key, val = re.split(r'\s+', line, 1)
-                self._report[key] = val.strip()
+            jobs = {}
+            for job in STATE_TRACKER.finished(self.engine_name) + [self]:
+                if job.cluster == self.cluster:
+                    jobs.update(job._get_report_jobs())
+            reports = REPORT_CACHE.fetch(self.cluster, self.engine, jobs)
+            task_reports = [reports.get(jobid) for jobid in self.task_jobids]
+            if all(task_reports):
+                # the first failed task's report for emulated job arrays
+                self._report = next((r for r in task_reports if r['exit_status'] != 0), task_reports[0])
         return self._report
 
+    @property
+    def cluster(self):
+        """The cluster the job runs on, the key of its reports in the REPORT_CACHE
+        (the location and the engine name; the same engine is used at more
+        locations, and job IDs are unique only within a cluster)."""
+        if self._cluster is None:
+            location = self.location
+            if location is None:
+                try:
+                    location = detect_location()
+                except Exception:
+                    location = ''
+            self._cluster = f'{location}/{self.engine_name}' if location else self.engine_name
+        return self._cluster
+
+    def _get_report_jobs(self):
+        """The job IDs of the job's tasks with what its reports must match, for REPORT_CACHE.fetch()."""
+        return {jobid: (self.name, self._submit_time) for jobid in self.task_jobids}
+
     @property
     def exit_status(self):
-        """Retrieve the exit status of the job via the qacct report.
+        """Retrieve the exit status of the job from its completion marker
+        or via the qacct report.
         Throws an exception the job is still running and the exit status
         is not known.
         """
-        report = self.report
-        if report is None:
-            raise RuntimeError('Job {self.jobid} is probably still running')
-        return int(report['exit_status'])
+        if self._done_status is not None or self.read_done_files():
+            exit_status = self._done_status
+        else:
+            report = self.report
+            if report is None:
+                raise RuntimeError('Job {self.jobid} is probably still running')
+            exit_status = int(report['exit_status'])
+        if exit_status == 0:
+            self._store_result()
+        return exit_status
 
     def wait(self, poll_delay=None):
         """Waits for the job to finish. Will raise an exception if the
-        job did not finish successfully. The poll_delay variable controls
-        how often the job state is checked.
+        job did not finish successfully.
+
+        The completion marker written by the job script is noticed right
+        away (watched with inotify, checked every TIME_MARKER_POLL seconds
+        otherwise). The batch engine is queried with delays growing from
+        TIME_POLL_MIN to TIME_POLL_DELAY; the poll_delay variable sets
+        a fixed delay instead.
         """
-        poll_delay = poll_delay if poll_delay else self.TIME_POLL_DELAY
-        while self.state != self.FINISH:
-            time.sleep(poll_delay)
+        delay = poll_delay if poll_delay else self.TIME_POLL_MIN
+        next_query = time.time()
+        with DirWatcher(os.path.dirname(self.done_file) if self.done_file else self.work_dir) as watcher:
+            while not self.read_done_files():
+                if time.time() >= next_query:
+                    if self.state == self.FINISH:
+                        break
+                    next_query = time.time() + delay
+                    if not poll_delay:
+                        delay = min(delay * self.TIME_POLL_BACKOFF, self.TIME_POLL_DELAY)
+                watcher.wait(min(self.TIME_MARKER_POLL, max(0, next_query - time.time())))
         if self.exit_status != 0:
             raise RuntimeError(f'Job {self.name} ({self.jobid}) did not finish successfully.')
 
+    def read_done_files(self):
+        """Check for the completion markers of all the job's tasks. If all
+        are present, store the exit status (the first non-zero one, if any),
+        remove the markers and return True.
+        """
+        if self._done_status is not None:
+            return True
+        if not self.submitted or not self.done_file:
+            return False
+        done_files = self._get_done_files()
+        if not all(os.path.exists(done_file) for done_file in done_files):
+            return False
+        statuses = []
+        for done_file in done_files:
+            try:
+                with open(done_file, 'r', encoding='UTF-8') as fh:
+                    statuses.append(int(fh.read().strip()))
+            except ValueError:
+                # not written completely yet
+                return False
+        self._remove_done_files()
+        self._done_status = next((st for st in statuses if st != 0), 0)
+        return True
+
+    def _remove_done_files(self):
+        """Remove the completion markers of all the job's tasks (if they exist)."""
+        for done_file in self._get_done_files():
+            _UNREAD_MARKERS.discard(done_file)
+            for path in (done_file, done_file + '.tmp'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _get_done_files(self):
+        """The completion markers of all the job's tasks."""
+        if self.array:
+            return [f'{self.done_file}.{task_id}' for task_id in self._get_array_task_ids()]
+        return [self.done_file]
+
+    async def wait_async(self):
+        """Asynchronous version of wait(). All jobs waited for in the
+        event loop share one polling task of the STATE_TRACKER.
+        """
+        import asyncio
+        await STATE_TRACKER.wait_async(self)
+        # the accounting report is retrieved by a blocking command
+        exit_status = await asyncio.get_running_loop().run_in_executor(None, lambda: self.exit_status)
+        if exit_status != 0:
+            raise RuntimeError(f'Job {self.name} ({self.jobid}) did not finish successfully.')
+
     def add_dependency(self, dependency):
         """Adds a dependency on the given Job(s).
         """
@@ -463,9 +830,8 @@ class Job:
             raise ValueError('Unknown dependency type!')
 
     def delete(self):
-        """Delete this job."""
-        if self.submitted:
-            subprocess.check_output(['qdel', self.jobid], encoding='UTF-8')
+        """Delete this job (all its tasks)."""
+        delete_jobs([self])
 
     @property
     def host(self):
@@ -479,7 +845,7 @@ class Job:
         if self._host is not None:
             return self._host
         # try to get state and return the stored value
-        self.state()
+        self.state
         return self._host
 
     @property
@@ -499,8 +865,9 @@ class Job:
         """
         if location != "ufal":
             return queue, gpus, self._parse_gpu_mem(location, gpu_mem, gpus)
-        gpu_options = ["gpu-troja","gpu-ms"]
-        cpu_options = ["cpu-troja","cpu-ms"]
+        resources = RESOURCE_CACHE.get(location, self.engine)
+        gpu_options = [q for q in UFAL_GPU_QUEUES if not resources or q in resources]
+        cpu_options = [q for q in UFAL_CPU_QUEUES if not resources or q in resources]
 
         if gpus is not None and gpus > 0:
             options = gpu_options
@@ -515,12 +882,17 @@ class Job:
         if selected == []:
             all_q = ", ".join(gpu_options+cpu_options)
             raise ValueError(f"Incorrect -queue parameter value. Possible values are {all_q}, or wildcard expression matching any of them.")
+        if resources and self.mem:
+            # the largest nodes, unknown memory (0) passes
+            max_mem = max(resources[q]['mem'] or float('inf') for q in selected)
+            if parse_mem(self.mem) > max_mem:
+                raise ValueError(f"No node in {', '.join(selected)} has {self.mem} of memory (at most {max_mem:.0f}M).")
         out_q = ",".join(selected)
         if "gpu" in out_q and (gpus is None or gpus == 0):
             gpus = 1
-        return out_q, gpus, self._parse_gpu_mem(location, gpu_mem, gpus)
+        return out_q, gpus, self._parse_gpu_mem(location, gpu_mem, gpus, selected)
 
-    def _parse_gpu_mem(self, location, gpu_mem, gpus):
+    def _parse_gpu_mem(self, location, gpu_mem, gpus, queues=()):
         if location != "ufal":
             if location == "ufal-aic":  # TODO change this to engine slurm
                 return " "
@@ -534,7 +906,15 @@ class Job:
         else:
             val = int(gpu_mem)
 
-        sizes = [ int(g[6:-1]) for g in UFAL_GPU_MEM_OPTIONS ]
+        resources = RESOURCE_CACHE.get(location, self.engine)
+        if resources and not any(r['gpu_mem'] for r in resources.values()):
+            # the nodes have no gpuram features anymore
+            return " "
+        if resources:
+            # only the sizes in the selected partitions, a constraint nothing matches would wait forever
+            sizes = sorted({s for q in queues if q in resources for s in resources[q]['gpu_mem']})
+        else:
+            sizes = [ int(g[6:-1]) for g in UFAL_GPU_MEM_OPTIONS ]
         possible_sizes = [ s for s in sizes if s >= val ]
         out = "|".join(f"gpuram{v}G" for v in possible_sizes)
         if out:
@@ -546,36 +926,89 @@ class Job:
 
 
 
-    def _get_code_script(self):
-        """Join headers and code to create a meaningful Python script."""
+    def _get_script(self, task_id=None):
+        """Return the job script text and the name of the temporary file it
+        is written to. If the engine takes the script on stdin, no file
+        is written and the name is None."""
+        if self.engine.get('script_stdin'):
+            return self._get_script_text(task_id, ''), None
         # create a script tempfile
-        script_tmpfile = NamedTemporaryFile(mode='w', suffix='.py', prefix='.qsubmit-', dir=os.getcwd(), encoding='UTF-8', delete=False)
-
-        script_text = self.code_templ
-        script_text = script_text.replace('<CODE>', re.sub('^', '    ', self.code, 0, re.MULTILINE))
-        script_text = script_text.replace('<CODE_TMPFILE>', script_tmpfile.name)
-
+        script_tmpfile = NamedTemporaryFile(mode='w', suffix='.py' if self.code else '.bash', prefix='.qsubmit-',
+                                            dir=os.path.abspath(self.work_dir), encoding='UTF-8', delete=False)
+        script_text = self._get_script_text(task_id, script_tmpfile.name)
+        # print it into the tempfile and close it
         script_tmpfile.write(script_text)
         script_tmpfile.close()
-        return script_tmpfile
+        return script_text, script_tmpfile.name
 
-    def _get_command_script(self):
-        # create a script tempfile
-        script_tmpfile = NamedTemporaryFile(mode='w', suffix='.bash', prefix='.qsubmit-', dir=os.getcwd(), encoding='UTF-8', delete=False)
+    def _get_script_text(self, task_id, script_name):
+        if self.code:
+            return self._get_code_script(task_id, script_name)
+        return self._get_command_script(task_id, script_name)
+
+    def _get_code_script(self, task_id, script_name):
+        """Join headers and code to create a meaningful Python script."""
+        script_text = self.code_templ
+        script_text = script_text.replace('<CODE>', re.sub('^', '    ', self.code, 0, re.MULTILINE))
+        script_text = script_text.replace('<CODE_TMPFILE>', script_name)
+        # the task index: the fixed index of an emulated task, or the engine's task index variable
+        if task_id is not None:
+            task_id_expr = repr(str(task_id))
+        else:
+            var = re.match(r'\$\{?(\w*)', self.engine['script']['task_id'] or '$')
+            task_id_expr = f"os.environ.get({var.group(1)!r}, '')" if var.group(1) else "''"
+            if self.engine_name == 'sge':
+                # SGE sets the variable to 'undefined' for single jobs
+                task_id_expr = f"{task_id_expr}.replace('undefined', '')"
+        script_text = script_text.replace('<TASK_ID>', task_id_expr)
+        if self.task_params:
+            # tasks are indexed from 1
+            params = repr([''] + self.task_params)
+            script_text = script_text.replace(
+                '<TASK_PARAMS>', f"os.environ['QSUBMIT_TASK_PARAM'] = {params}[int(os.environ['QSUBMIT_TASK_ID'])]")
+        else:
+            script_text = script_text.replace('<TASK_PARAMS>', '')
+        # job array tasks write separate completion markers, as in the command script
+        done_file = self.done_file + ('.$QSUBMIT_TASK_ID' if self.array else '') if self.done_file else ''
+        script_text = script_text.replace('<DONE_FILE>', done_file)
+        return script_text
 
+    def _get_command_script(self, task_id, script_name):
         # create script text
         script_text = self.script_templ
+        # emulated job array task: fixed task index instead of the engine's variable
+        if task_id is not None:
+            script_text = script_text.replace('<TASK_ID>', str(task_id))
+        script_text = script_text.replace('<TASK_PARAMS>', self._get_task_params_string())
         for var_name, value in self.engine['script'].items():
             script_text = script_text.replace('<' + var_name.upper() + '>', value)
-        script_text = script_text.replace('<SCRIPT_TMPFILE>', script_tmpfile.name)
+        script_text = script_text.replace('<SCRIPT_TMPFILE>', script_name)
+        # job array tasks write separate completion markers
+        done_file = self.done_file + ('.$QSUBMIT_TASK_ID' if self.array else '') if self.done_file else ''
+        script_text = script_text.replace('<DONE_FILE>', done_file)
         main_cmd = ' '.join([shlex.quote(t) for t in self.command]) if isinstance(self.command, list) else self.command
         script_text = script_text.replace('<MAIN_CMD>', main_cmd)
         script_text = script_text.replace('<MAIN_CMD_ESC>', main_cmd.replace("'", "'\"'\"'"))
-
-        # print it into a tempfile and close it
-        script_tmpfile.write(script_text)
-        script_tmpfile.close()
-        return script_tmpfile
+        return script_text
+
+    def _get_task_params_string(self):
+        """Generate the bash code selecting the per-task parameter of job arrays."""
+        if not self.task_params:
+            return ''
+        # tasks are indexed from 1
+        params = ' '.join(["''"] + [shlex.quote(p) for p in self.task_params])
+        return f'QSUBMIT_TASK_PARAMS=({params})\nexport QSUBMIT_TASK_PARAM="${{QSUBMIT_TASK_PARAMS[$QSUBMIT_TASK_ID]}}"'
+
+    def _get_array_task_ids(self):
+        """List the task indexes given by the job array range (e.g. '1-10:2,15')."""
+        task_ids = []
+        for part in str(self.array).split('%')[0].split(','):
+            m = re.match(r'^([0-9]+)(?:-([0-9]+)(?::([0-9]+))?)?$', part.strip())
+            if not m:
+                raise ValueError(f'Cannot parse job array range: {self.array}')
+            first, last, step = m.groups()
+            task_ids.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+        return task_ids
 
     def _generate_name(self):
         """Generate a job name"""
@@ -614,26 +1047,16 @@ class Job:
             if not all([dep.submitted if isinstance(dep, Job) else True
                         for dep in self._dependencies]):
                 raise RuntimeError('Job has unsubmitted dependencies!')
-            hold_str = ','.join([dep.jobid if isinstance(dep, Job) else dep for dep in self._dependencies])
-            return shlex.split(self.engine['params']['hold'].replace('<HOLD>', hold_str))
+            # jobs with cached results were not queued, there is nothing to wait for
+            hold_str = ','.join([jobid for dep in self._dependencies
+                                 for jobid in (dep.task_jobids if isinstance(dep, Job) else [dep])
+                                 if jobid is not None])
+            if not hold_str:
+                return []
+            hold = self.engine['params'].get('hold_ok') if self.hold_ok else None
+            return shlex.split((hold or self.engine['params']['hold']).replace('<HOLD>', hold_str))
         return []
 
-    def _get_job_state(self):
-        """Parse the qstat command and try to retrieve the current job
-        state and the machine it is running on."""
-        # get state of job assuming it is in the queue
-        output = subprocess.check_output(['qstat'], encoding='UTF-8')
-        # get the relevant line of the qstat output
-        output = next((l for l in output.split("\n") if re.search(self.jobid, l)), None)
-        # job does not exist anymore
-        if output is None:
-            return self.FINISH, None
-        # parse the correct line:
-        fields = re.split(r'\s+', output.strip()) + [''] * 7
-        state, host = fields[4], fields[7]
-        host = re.sub(r'.*@([^.]+)\..*', r'\1', host) if '@' in host else ''
-        return state, host
-
     def __eq__(self, other):
         """Comparison: based on ids or reference if ids are None."""
         if self._jobid is not None and other.__jobid is not None:
@@ -643,3 +1066,258 @@ class Job:
     def __str__(self):
         """String representation returns the attribute name and type."""
         return f'{self.__class__.__name__}: {self.name} ({self.work_dir})'
+
+
+
+class JobStateTracker:
+    """Process-wide tracker of job states. Instead of running a full qstat
+    for each job, all watched unfinished jobs of one engine are refreshed
+    with a single batch engine query (at most once per refresh interval),
+    parsed into a dictionary keyed by job IDs.
+    """
+
+    def __init__(self, interval=Job.TIME_QUERY_DELAY):
+        self.interval = interval
+        # (engine name, job ID) -> Job, finished jobs are forgotten with their Job object
+        self._jobs = weakref.WeakValueDictionary()
+        # (engine name, job ID) -> (state, host)
+        self._states = {}
+        self._last_refresh = 0
+        self._lock = threading.RLock()
+        # asynchronous waiting: (job, future) pairs and the shared polling task
+        self._waiters = []
+        self._poller = None
+
+    def watch(self, job):
+        """Start tracking the state of the given (submitted) job."""
+        with self._lock:
+            for jobid in job.task_jobids:
+                self._jobs[(job.engine_name, jobid)] = job
+
+    def state(self, engine_name, jobid):
+        """Return the (state, host) pair for the given job. The states
+        of all watched jobs are refreshed if they are too old or if this
+        job has not been queried yet.
+        """
+        key = (engine_name, jobid)
+        with self._lock:
+            if key not in self._states or time.time() >= self._last_refresh + self.interval:
+                self.refresh()
+            return self._states.get(key, (Job.FINISH, None))
+
+    def refresh(self):
+        """Query the batch engines for the states of all watched
+        unfinished jobs (one query per engine)."""
+        with self._lock:
+            self._last_refresh = time.time()
+            # forget jobs whose Job objects are gone
+            for key in [key for key in self._states if key not in self._jobs]:
+                del self._states[key]
+            for engine_name, jobids in self._unfinished().items():
+                engine = ENGINES[engine_name]
+                if 'state_cmd' not in engine:
+                    current = self._unqueried_states(engine, engine_name, jobids)
+                else:
+                    current = self._parse_states(engine, self._run_query(self._query_cmd(engine, jobids)))
+                self._update(engine_name, jobids, current)
+
+    async def refresh_async(self):
+        """Asynchronous version of refresh(), the queries run as asyncio subprocesses."""
+        import asyncio
+        with self._lock:
+            self._last_refresh = time.time()
+            unfinished = self._unfinished()
+        for engine_name, jobids in unfinished.items():
+            engine = ENGINES[engine_name]
+            if 'state_cmd' not in engine:
+                with self._lock:
+                    current = self._unqueried_states(engine, engine_name, jobids)
+            else:
+                cmd = self._query_cmd(engine, jobids)
+                proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE)
+                output, errors = await proc.communicate()
+                output, errors = output.decode('UTF-8'), errors.decode('UTF-8')
+                if proc.returncode != 0 and 'Invalid job id' not in errors:
+                    raise subprocess.CalledProcessError(proc.returncode, cmd, output, errors)
+                current = self._parse_states(engine, output if proc.returncode == 0 else '')
+            with self._lock:
+                self._update(engine_name, jobids, current)
+
+    async def wait_async(self, job):
+        """Wait until the given job finishes. All the waiting jobs are
+        checked by a single polling task."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append((job, future))
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll_async())
+        await future
+
+    async def _poll_async(self):
+        """Check the jobs with asynchronous waiters until there are none:
+        their completion markers every Job.TIME_MARKER_POLL seconds, the
+        batch engine with delays growing up to Job.TIME_POLL_DELAY."""
+        import asyncio
+        delay = Job.TIME_POLL_MIN
+        next_refresh = time.time()
+        while self._waiters:
+            refreshed = time.time() >= next_refresh
+            if refreshed:
+                try:
+                    await self.refresh_async()
+                except Exception as e:
+                    for _, future in self._waiters:
+                        if not future.done():
+                            future.set_exception(e)
+                    self._waiters = []
+                    return
+                next_refresh = time.time() + delay
+                delay = min(delay * Job.TIME_POLL_BACKOFF, Job.TIME_POLL_DELAY)
+            waiting = []
+            for job, future in self._waiters:
+                if future.done():
+                    continue
+                if job.read_done_files() or (refreshed and self._is_finished(job)):
+                    future.set_result(job)
+                else:
+                    waiting.append((job, future))
+            self._waiters = waiting
+            if waiting:
+                await asyncio.sleep(min(Job.TIME_MARKER_POLL, max(0, next_refresh - time.time())))
+
+    def finished(self, engine_name):
+        """List all watched jobs of the given engine with finished tasks."""
+        with self._lock:
+            jobs = [self._jobs.get((engine, jobid)) for (engine, jobid), (state, _) in self._states.items()
+                    if engine == engine_name and state == Job.FINISH]
+        return list({id(job): job for job in jobs if job is not None}.values())
+
+    def _is_finished(self, job):
+        """Check the stored states of all job's tasks, without querying the engine."""
+        with self._lock:
+            return all(self._states.get((job.engine_name, jobid), (None,))[0] == Job.FINISH
+                       for jobid in job.task_jobids)
+
+    def _unfinished(self):
+        """Return watched unfinished job IDs, grouped by engine names."""
+        by_engine = {}
+        for engine_name, jobid in list(self._jobs.keys()):
+            if self._states.get((engine_name, jobid), (None,))[0] != Job.FINISH:
+                by_engine.setdefault(engine_name, []).append(jobid)
+        return by_engine
+
+    def _update(self, engine_name, jobids, current):
+        """Store the current states, jobs missing in the query output are finished."""
+        for jobid in jobids:
+            key = (engine_name, jobid)
+            if jobid in current:
+                self._states[key] = current[jobid]
+            else:
+                # keep the last known host of finished jobs
+                self._states[key] = (Job.FINISH, self._states.get(key, (None, None))[1])
+
+    def _unqueried_states(self, engine, engine_name, jobids):
+        """States of jobs of an engine without a query: finished during the
+        submission for synchronous engines (console), unknown otherwise
+        (the completion marker tells when the job ends)."""
+        if engine.get('synchronous'):
+            return {}
+        return {jobid: self._states.get((engine_name, jobid), (Job.UNKNOWN, None)) for jobid in jobids}
+
+    @staticmethod
+    def _query_cmd(engine, jobids):
+        return shlex.split(engine['state_cmd'].replace('<JOB_IDS>', ','.join(jobids)))
+
+    @staticmethod
+    def _run_query(cmd):
+        res = subprocess.run(cmd, encoding='UTF-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # squeue fails if none of the given jobs is known anymore
+        if res.returncode != 0 and 'Invalid job id' not in res.stderr:
+            raise subprocess.CalledProcessError(res.returncode, cmd, res.stdout, res.stderr)
+        return res.stdout if res.returncode == 0 else ''
+
+    @staticmethod
+    def _parse_states(engine, output):
+        """Parse the state query output into a dictionary job ID -> (state, host)."""
+        id_field, state_field, host_field = engine['state_fields']
+        states = {}
+        for line in output.split("\n"):
+            fields = re.split(r'\s+', line.strip()) + [''] * 7
+            # array job tasks are listed as 123_4 or 123.4
+            m = re.match(r'([0-9]+)', fields[id_field])
+            if not m:
+                continue
+            host = fields[host_field]
+            host = re.sub(r'.*@([^.]*).*', r'\1', host) if '@' in host else ''
+            states.setdefault(m.group(1), (fields[state_field], host))
+        return states
+
+
+# the tracker shared by all Job objects in this process
+STATE_TRACKER = JobStateTracker()
+
+# accounting reports of finished jobs, shared by all Job objects and cached on disk
+REPORT_CACHE = ReportCache()
+# resources of the clusters, by location
+RESOURCE_CACHE = ResourceCache()
+# results of successful jobs with the cache on, on disk
+RESULT_CACHE = ResultCache()
+
+# completion markers of the submitted jobs, until they are read (the markers of the
+# jobs that are still running at exit are left behind, see Job.done_marker)
+_UNREAD_MARKERS = set()
+
+
+@atexit.register
+def _remove_unread_markers():
+    for done_file in list(_UNREAD_MARKERS):
+        for path in (done_file, done_file + '.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def fetch_reports(jobs):
+    """Retrieve accounting reports of all the given finished jobs at once
+    (one call per cluster), so that accessing their report or exit_status
+    afterwards does not query the engine again.
+    """
+    by_cluster = {}
+    for job in jobs:
+        if job.submitted and job.state == Job.FINISH:
+            by_cluster.setdefault(job.cluster, (job.engine, {}))[1].update(job._get_report_jobs())
+    for cluster, (engine, report_jobs) in by_cluster.items():
+        REPORT_CACHE.fetch(cluster, engine, report_jobs)
+
+
+def delete_jobs(jobs):
+    """Delete all the given submitted jobs, with one call per engine
+    (the delete_cmd takes more job IDs separated by spaces)."""
+    by_engine = {}
+    for job in jobs:
+        if job.submitted and job.jobid is not None and 'delete_cmd' in job.engine:
+            by_engine.setdefault(job.engine_name, (job.engine, [], []))[1].extend(job.task_jobids)
+            by_engine[job.engine_name][2].append(job)
+    for engine_name, (engine, jobids, deleted) in by_engine.items():
+        cmd = shlex.split(engine['delete_cmd'].replace('<JOB_ID>', ' '.join(jobids)))
+        subprocess.check_output(cmd, encoding='UTF-8')
+        # the deleted jobs will not read their completion markers (of the tasks that have finished)
+        for job in deleted:
+            if job.done_file is not None and job._done_status is None:
+                job._remove_done_files()
+
+
+async def as_completed(jobs):
+    """Asynchronous generator yielding the given submitted jobs as they
+    finish (successfully or not, check their exit_status).
+    """
+    import asyncio
+    pending = {asyncio.ensure_future(STATE_TRACKER.wait_async(job)): job for job in jobs}
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+            yield pending.pop(task)
\ No newline at end of file
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Accounting reports of finished jobs (sacct on Slurm, qacct on SGE).
+
+Reports are fetched for many jobs with one call and normalized, so that
+all of them have the following keys (plus the engine's own ones):
+jobid, name, state, exit_status (int), host, start, end.
+Reports of finished jobs never change, so they are kept in an on-disk
+cache (per cluster) and no job is ever asked about twice. As job IDs
+are reused, a cached report is trusted only if it was cached after
+the job was submitted and has the job's name.
+"""
+
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+from qsubmit.config import cache_path
+
+
+# sacct fields, in the order of the --format option of the report_cmd
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'ExitCode', 'NodeList', 'Start', 'End', 'Elapsed', 'MaxRSS']
+# Slurm job states after which the accounting record does not change anymore
+SLURM_FINAL_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL',
+                      'PREEMPTED', 'BOOT_FAIL', 'DEADLINE'}
+# maximum number of job IDs given to one sacct call
+REPORT_BATCH = 1000
+# cached reports older than this (in seconds) are dropped
+REPORT_MAX_AGE = 90 * 24 * 3600
+
+
+def _parse_exit_code(exit_code):
+    """Convert sacct's ExitCode (status:signal) into a shell-like exit status."""
+    status, _, signal = exit_code.partition(':')
+    status, signal = int(status or 0), int(signal or 0)
+    return status if status or not signal else 128 + signal
+
+
+def parse_sacct(output):
+    """Parse sacct -P output into a dictionary job ID -> report."""
+    reports = {}
+    for line in output.split("\n"):
+        if not line.strip():
+            continue
+        report = dict(zip(SACCT_FIELDS, line.split('|')))
+        # job steps (123.batch, 123.extern) are skipped, array tasks (123_4) are joined
+        if '.' in report['JobID']:
+            continue
+        report.update({
+            'jobid': report['JobID'],
+            'name': report.get('JobName', ''),
+            'state': report.get('State', '').split(' ')[0],
+            'exit_status': _parse_exit_code(report.get('ExitCode', '')),
+            'host': report.get('NodeList', ''),
+            'start': report.get('Start', ''),
+            'end': report.get('End', ''),
+        })
+        _add_report(reports, re.match(r'[0-9]+', report['jobid']).group(0), report)
+    return reports
+
+
+def parse_qacct(output):
+    """Parse qacct -j output (records delimited by lines of '=') into
+    a dictionary job ID -> report."""
+    reports = {}
+    for record in re.split(r'^=+\s*$', output, flags=re.MULTILINE):
+        report = {}
+        for line in record.split("\n"):
+            if ' ' not in line.strip():
+                continue
+            key, val = re.split(r'\s+', line.strip(), 1)
+            report[key] = val.strip()
+        if 'jobnumber' not in report:
+            continue
+        exit_status = int(report.get('exit_status', '0').split(' ')[0])
+        report.update({
+            'jobid': report['jobnumber'],
+            'name': report.get('jobname', ''),
+            'state': 'FAILED' if exit_status or report.get('failed', '0') != '0' else 'COMPLETED',
+            'exit_status': exit_status,
+            'host': report.get('hostname', ''),
+            'start': report.get('start_time', ''),
+            'end': report.get('end_time', ''),
+        })
+        _add_report(reports, report['jobid'], report)
+    return reports
+
+
+def _add_report(reports, jobid, report):
+    """Store the report, for job arrays keep the first failed task's report."""
+    if jobid not in reports or (reports[jobid]['exit_status'] == 0 and report['exit_status'] != 0):
+        reports[jobid] = report
+
+
+REPORT_PARSERS = {
+    'sacct': parse_sacct,
+    'qacct': parse_qacct,
+}
+
+
+class ReportCache:
+    """Accounting reports of finished jobs, fetched in batches and cached
+    on disk (a JSON file, by default in the user's cache directory), keyed
+    by clusters (see Job.cluster) and job IDs."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._reports = None
+        self._lock = threading.RLock()
+
+    def get(self, cluster, jobid):
+        """Return the cached report for the given job ID, or None."""
+        with self._lock:
+            return self._load().get(cluster, {}).get(jobid)
+
+    def fetch(self, cluster, engine, jobs):
+        """Return reports for the given jobs (as a dictionary job ID -> report),
+        querying the engine only for those not yet cached, in as few calls
+        as possible. The jobs are given as a dictionary job ID -> (job name,
+        submission time), either may be None if unknown; cached reports of
+        earlier jobs with the same IDs are queried again. Jobs the engine
+        knows nothing about yet are missing in the result.
+        """
+        with self._lock:
+            cached = self._load().setdefault(cluster, {})
+            missing = sorted(jobid for jobid, job in jobs.items()
+                             if jobid not in cached or not self._matches(cached[jobid], *job))
+            if missing and 'report_cmd' in engine:
+                fetched = {}
+                for i in range(0, len(missing), REPORT_BATCH):
+                    fetched.update(self._query(engine, missing[i:i + REPORT_BATCH]))
+                now = time.time()
+                new_reports = {}
+                for jobid in missing:
+                    # only final reports are cached, running array tasks may still change
+                    if jobid in fetched and self._is_final(fetched[jobid]):
+                        fetched[jobid]['cached_time'] = now
+                        new_reports[jobid] = cached[jobid] = fetched[jobid]
+                self._save(cluster, new_reports)
+            return {jobid: cached[jobid] for jobid, job in jobs.items()
+                    if jobid in cached and self._matches(cached[jobid], *job)}
+
+    @staticmethod
+    def _query(engine, jobids):
+        if len(jobids) > 1 and 'report_scan_cmd' in engine:
+            # one scan of the whole accounting file, filtered afterwards
+            cmd = shlex.split(engine['report_scan_cmd'])
+        else:
+            cmd = shlex.split(engine['report_cmd'].replace('<JOB_IDS>', ','.join(jobids)))
+        output = subprocess.run(cmd, encoding='UTF-8', stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        reports = REPORT_PARSERS[engine['report_format']](output)
+        return {jobid: reports[jobid] for jobid in jobids if jobid in reports}
+
+    @staticmethod
+    def _matches(report, name, submit_time):
+        """Check that the report is of the given job, not of an earlier one with the same ID."""
+        if submit_time is not None and report.get('cached_time', 0) < submit_time:
+            return False
+        return not name or not report.get('name') or report['name'] == name
+
+    @staticmethod
+    def _is_final(report):
+        return 'jobnumber' in report or report['state'] in SLURM_FINAL_STATES
+
+    def _get_path(self):
+        return self.path or cache_path('reports.json')
+
+    def _load(self):
+        if self._reports is None:
+            self._reports = self._read()
+        return self._reports
+
+    def _read(self):
+        try:
+            with open(self._get_path(), 'r', encoding='UTF-8') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, cluster, new_reports):
+        """Merge the new reports into the file (which other processes may
+        have updated meanwhile), dropping too old ones, and replace it
+        atomically."""
+        if not new_reports:
+            return
+        reports = self._read()
+        reports.setdefault(cluster, {}).update(new_reports)
+        min_time = time.time() - REPORT_MAX_AGE
+        for cluster_reports in reports.values():
+            for jobid in [jobid for jobid, report in cluster_reports.items()
+                          if report.get('cached_time', 0) < min_time]:
+                del cluster_reports[jobid]
+        path = self._get_path()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='UTF-8') as fh:
+                json.dump(reports, fh)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is just an optimization
+            pass
+        self._reports = reports
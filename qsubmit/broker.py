@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Submission of many jobs at once: Job.submit() runs in a bounded pool of
+threads (it passes the working directory to the submit command, so it is
+safe to call concurrently), rate-limited by a token bucket so that the
+scheduler is not flooded.
+
+    with SubmissionBroker(threads=8, rate=20) as broker:
+        latencies = broker.submit_all(jobs)
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """Allows rate events per second on average, and bursts of up to burst
+    events after a quiet period."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _job_dependencies(job):
+    """The Job objects the job depends on (not the plain job IDs)."""
+    return [dep for dep in job._dependencies if not isinstance(dep, str)]
+
+
+class SubmissionBroker:
+    """Submits jobs in a pool of threads, at most rate submissions per second
+    (with bursts of up to burst), or without a limit if rate is None.
+
+    submit() returns a Future with the submission latency of the job in
+    seconds (waiting for the rate limit included), which is also stored
+    in the job's submit_latency attribute.
+    """
+
+    def __init__(self, threads=8, rate=None, burst=None, print_cmd=None):
+        self.print_cmd = print_cmd
+        self.bucket = TokenBucket(rate, burst or max(1, int(rate))) if rate else None
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='qsubmit-broker')
+        # id(job) -> (job, future), for the dependencies among the submitted jobs
+        # (Jobs are not hashable); forgotten when the job is submitted
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Schedule the job's submission, return a Future. The jobs it depends
+        on and which are submitted by this broker are waited for, they must
+        have been given to submit() before."""
+        with self._lock:
+            deps = [self._futures[id(dep)][1] for dep in _job_dependencies(job) if id(dep) in self._futures]
+            future = self._pool.submit(self._submit, job, deps, time.monotonic())
+            self._futures[id(job)] = (job, future)
+        future.add_done_callback(lambda f: self._forget(job, f))
+        return future
+
+    def submit_all(self, jobs):
+        """Submit the jobs (their dependencies first) and wait until all are
+        submitted. Return their submission latencies, in the given order.
+        The first submission error is raised."""
+        futures = {id(job): self.submit(job) for job in self._dependencies_first(jobs)}
+        return [futures[id(job)].result() for job in jobs]
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _forget(self, job, future):
+        # the failed ones stay, so that their dependent jobs fail as well
+        if future.exception() is None:
+            with self._lock:
+                if self._futures.get(id(job), (None, None))[1] is future:
+                    del self._futures[id(job)]
+
+    def _submit(self, job, deps, queued):
+        for dep in deps:
+            # an error of the dependency is raised here as well
+            dep.result()
+        if self.bucket is not None:
+            self.bucket.acquire()
+        job.submit(print_cmd=self.print_cmd)
+        job.submit_latency = time.monotonic() - queued
+        return job.submit_latency
+
+    @staticmethod
+    def _dependencies_first(jobs):
+        """The jobs ordered so that each comes after the ones it depends on,
+        otherwise in the given order. With this order, a job waiting for its
+        dependency never blocks it out of the pool."""
+        ordered, seen = [], set()
+        batch = {id(job) for job in jobs}
+
+        def visit(job, path):
+            if id(job) in seen:
+                return
+            if id(job) in path:
+                raise ValueError(f'Cyclic dependency of job {job.name}')
+            for dep in _job_dependencies(job):
+                if id(dep) in batch:
+                    visit(dep, path | {id(job)})
+            seen.add(id(job))
+            ordered.append(job)
+
+        for job in jobs:
+            visit(job, frozenset())
+        return ordered
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Compression of the chunk files that qruncmd and qwrapcmd pass through
+the workdir. gzip is always available, lz4 and zstd need the lz4 and
+zstandard packages (pip install qsubmit[lz4] or qsubmit[zstd]).
+"""
+
+import gzip
+
+# the chunks are written once and read once, fast compression pays off
+GZIP_LEVEL = 1
+
+
+def _open_gzip(path, mode):
+    return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+
+
+def _open_lz4(path, mode):
+    import lz4.frame
+    return lz4.frame.open(path, mode)
+
+
+def _open_zstd(path, mode):
+    import zstandard
+    return zstandard.open(path, mode)
+
+
+CODECS = {
+    'gzip': _open_gzip,
+    'lz4': _open_lz4,
+    'zstd': _open_zstd,
+}
+
+CODEC_MODULES = {
+    'lz4': 'lz4.frame',
+    'zstd': 'zstandard',
+}
+
+
+def check_codec(codec):
+    """Raise ImportError if the codec's package is not installed."""
+    if codec in CODEC_MODULES:
+        __import__(CODEC_MODULES[codec])
+
+
+def open_chunk(path, mode='rb', codec=None):
+    """Open a chunk file for binary reading ('rb') or writing ('wb'),
+    (de)compressing it with the given codec, or not at all if it is None."""
+    if codec is None:
+        return open(path, mode)
+    return CODECS[codec](path, mode)
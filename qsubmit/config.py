@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""User-level qsubmit files: the cache directory and the configuration
+file (~/.qsubmitrc, or $QSUBMIT_CONFIG), e.g.:
+
+    [qsubmit]
+    # skip the location detection
+    location = mycluster
+
+    [location mycluster]
+    engine = slurm
+    hostname = .*\\.mycluster\\.org
+
+The [location NAME] sections add new locations or override the preset ones.
+"""
+
+import json
+import os
+import socket
+import time
+
+
+# the detected location of a host is checked again after this many seconds
+LOCATION_CACHE_MAX_AGE = 30 * 24 * 3600
+
+
+def cache_path(*parts):
+    """Return a path in the user's qsubmit cache directory ($QSUBMIT_CACHE_DIR,
+    or qsubmit/ in $XDG_CACHE_HOME or ~/.cache). The directory is created
+    if it does not exist.
+    """
+    cache_dir = os.environ.get('QSUBMIT_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'qsubmit')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, *parts)
+
+
+def config_path():
+    return os.environ.get('QSUBMIT_CONFIG') or os.path.expanduser('~/.qsubmitrc')
+
+
+def load_config(path=None):
+    """Read the configuration file, return a ConfigParser, or None if there is no file."""
+    path = path or config_path()
+    if not os.path.exists(path):
+        return None
+    # imported only when needed, every CLI call reads the configuration
+    import configparser
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        config.read(path, encoding='UTF-8')
+    except configparser.Error as e:
+        raise ValueError(f'Cannot parse {path}: {e}')
+    return config
+
+
+def config_locations(config):
+    """The locations defined in the configuration, as a dictionary name -> parameters."""
+    if config is None:
+        return {}
+    return {section.split(None, 1)[1]: dict(config[section])
+            for section in config.sections() if section.startswith('location ')}
+
+
+def configured_location(config):
+    """The location set in the [qsubmit] section, or None."""
+    if config is None:
+        return None
+    return config.get('qsubmit', 'location', fallback=None) or None
+
+
+def cached_location(locations):
+    """The location detected on this host before, if it is still one of the
+    given locations and not too old, otherwise None. The cache is keyed by the
+    plain hostname, so that no DNS lookup is needed to find it."""
+    try:
+        with open(cache_path('locations.json'), 'r', encoding='UTF-8') as fh:
+            entry = json.load(fh).get(socket.gethostname())
+    except (OSError, ValueError):
+        return None
+    if not entry or entry.get('location') not in locations:
+        return None
+    # a changed pattern of the location may not match the host anymore
+    if entry.get('hostname') != locations[entry['location']].get('hostname'):
+        return None
+    if entry.get('cached_time', 0) < time.time() - LOCATION_CACHE_MAX_AGE:
+        return None
+    return entry['location']
+
+
+def cache_location(location, locations):
+    """Remember the location detected on this host (see cached_location)."""
+    try:
+        path = cache_path('locations.json')
+        with open(path, 'r', encoding='UTF-8') as fh:
+            cache = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    except OSError:
+        # e.g. the cache directory cannot be created
+        return
+    cache[socket.gethostname()] = {'location': location,
+                                   'hostname': locations[location].get('hostname'),
+                                   'cached_time': time.time()}
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='UTF-8') as fh:
+            json.dump(cache, fh)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the cache is just an optimization
+        pass
+
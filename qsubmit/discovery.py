@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Discovery of the cluster's resources (sinfo on Slurm, qhost on SGE), so
+that the jobs only ask for hardware that actually exists.
+
+The resources are normalized into a dictionary partition (queue) name ->
+{'gpus': whether some node there has GPUs, 'gpu_mem': sorted GPU memory
+sizes of its nodes in GB, 'mem': memory of its largest node in MB}.
+They change rarely, so they are kept in an on-disk cache for a day.
+"""
+
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+from qsubmit.config import cache_path
+
+
+# cached resources older than this (in seconds) are discovered again
+RESOURCES_MAX_AGE = 24 * 3600
+# sinfo -N prints one line per node and partition, the fields of the resources_cmd:
+# node, partition, features, memory (MB), generic resources (e.g. gpu:4)
+SINFO_FIELDS = ['node', 'partition', 'features', 'mem', 'gres']
+# the GPU memory size of a node is one of its Slurm features, e.g. gpuram24G
+SLURM_GPU_MEM_FEATURE = r'^gpuram([0-9]+)G$'
+
+MEM_UNITS = {'k': 1 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+
+
+def parse_mem(mem):
+    """Convert a memory size (e.g. 4g, 500M, 15.5G; MB if there is no unit) to MB."""
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)b?\s*$', str(mem), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Cannot parse memory size {mem}')
+    return float(match.group(1)) * MEM_UNITS[match.group(2).lower() or 'm']
+
+
+def _add_node(partitions, partition, gpus, gpu_mem, mem):
+    params = partitions.setdefault(partition, {'gpus': False, 'gpu_mem': [], 'mem': 0})
+    params['gpus'] = params['gpus'] or gpus
+    if gpu_mem is not None and gpu_mem not in params['gpu_mem']:
+        params['gpu_mem'] = sorted(params['gpu_mem'] + [gpu_mem])
+    params['mem'] = max(params['mem'], mem)
+
+
+def parse_sinfo(output):
+    """Parse sinfo -N output into a dictionary partition -> resources."""
+    partitions = {}
+    for line in output.split("\n"):
+        if not line.strip():
+            continue
+        node = dict(zip(SINFO_FIELDS, line.split('|')))
+        gpu_mem = None
+        for feature in node.get('features', '').split(','):
+            match = re.match(SLURM_GPU_MEM_FEATURE, feature)
+            if match:
+                gpu_mem = int(match.group(1))
+        try:
+            mem = int(node.get('mem', '0').rstrip('+'))
+        except ValueError:
+            mem = 0
+        # the default partition is marked with an asterisk
+        _add_node(partitions, node['partition'].rstrip('*'), 'gpu' in node.get('gres', ''), gpu_mem, mem)
+    return partitions
+
+
+def parse_qhost(output):
+    """Parse qhost -q -F gpu_ram output (host lines, each followed by indented
+    lines of its queues and resources) into a dictionary queue -> resources."""
+    partitions = {}
+    hosts = []
+    for line in output.split("\n"):
+        if not line.strip() or line.startswith(('HOSTNAME', '---', 'global')):
+            continue
+        if not line[0].isspace():
+            fields = line.split()
+            try:
+                mem = parse_mem(fields[7])
+            except (IndexError, ValueError):
+                mem = 0
+            hosts.append({'queues': [], 'gpu_mem': None, 'mem': mem})
+            continue
+        if not hosts:
+            continue
+        match = re.match(r'^\s*[a-zA-Z]{2}:gpu_ram=(.*)$', line)
+        if match:
+            hosts[-1]['gpu_mem'] = int(round(parse_mem(match.group(1)) / 1024))
+        else:
+            hosts[-1]['queues'].append(line.split()[0])
+    for host in hosts:
+        for queue in host['queues']:
+            _add_node(partitions, queue, host['gpu_mem'] is not None, host['gpu_mem'], host['mem'])
+    return partitions
+
+
+RESOURCE_PARSERS = {
+    'sinfo': parse_sinfo,
+    'qhost': parse_qhost,
+}
+
+
+class ResourceCache:
+    """Resources of the clusters, discovered once in RESOURCES_MAX_AGE and
+    cached on disk (a JSON file, by default in the user's cache directory),
+    keyed by location names."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._resources = None
+        # locations where the discovery failed, not tried again in this process
+        self._failed = set()
+        self._lock = threading.RLock()
+
+    def get(self, location, engine):
+        """Return the resources of the given location (see the module docs),
+        or None if the engine cannot tell (e.g. its command is not found here).
+        """
+        with self._lock:
+            cached = self._load().get(location)
+            if cached is not None and cached['cached_time'] >= time.time() - RESOURCES_MAX_AGE:
+                return cached['partitions']
+            if 'resources_cmd' not in engine or location in self._failed:
+                return None
+            partitions = self._query(engine)
+            if not partitions:
+                self._failed.add(location)
+                return None
+            self._save(location, {'cached_time': time.time(), 'partitions': partitions})
+            return partitions
+
+    @staticmethod
+    def _query(engine):
+        cmd = shlex.split(engine['resources_cmd'])
+        try:
+            output = subprocess.run(cmd, encoding='UTF-8', stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        except OSError:
+            return None
+        return RESOURCE_PARSERS[engine['resources_format']](output)
+
+    def _get_path(self):
+        return self.path or cache_path('resources.json')
+
+    def _load(self):
+        if self._resources is None:
+            self._resources = self._read()
+        return self._resources
+
+    def _read(self):
+        try:
+            with open(self._get_path(), 'r', encoding='UTF-8') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, location, resources):
+        """Merge the location's resources into the file and replace it atomically."""
+        cache = self._read()
+        cache[location] = resources
+        path = self._get_path()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='UTF-8') as fh:
+                json.dump(cache, fh)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is just an optimization
+            pass
+        self._resources = cache
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Running Python callables on the cluster through the concurrent.futures
+interface:
+
+    with ClusterExecutor(cpus=8, mem='16g') as executor:
+        squares = list(executor.map(square, range(10000), chunksize=1000))
+        future = executor.submit(train, 'model.pt', epochs=10)
+        print(future.result())
+
+The calls are pickled (with cloudpickle if it is installed, so that lambdas
+and functions defined in __main__ work as well; pip install qsubmit[cloudpickle])
+and packed into batches, one cluster job each: submit() collects the calls
+into batches of batch_size, sent after batch_delay seconds at the latest,
+map() sends each chunk as a batch. The jobs are submitted through
+a SubmissionBroker.
+
+Inside the job, the batch is run by this module (python -m qsubmit.executor)
+in a local pool of processes sized to the job's cpus, and the result of each
+call is written to the executor's directory (in the working directory, which
+must be shared with the nodes) as soon as it is ready. A single thread of the
+executor picks the results up and resolves their futures, so they stream back
+while the batches are still running. The futures of a job that ends without
+their results (e.g. it is killed) fail with a RuntimeError.
+"""
+
+import os
+import pickle
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, as_completed
+
+from qsubmit.fswatch import DirWatcher
+
+
+# how many calls submit() packs into one job at most
+EXECUTOR_BATCH_SIZE = 100
+# how long (in seconds) submit() waits for more calls before sending an incomplete batch
+EXECUTOR_BATCH_DELAY = 1
+# the directory containing the qsubmit package, put on the jobs' PYTHONPATH
+_PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _pickler():
+    """cloudpickle if it is installed (it pickles functions by value), pickle otherwise."""
+    try:
+        import cloudpickle
+        return cloudpickle
+    except ImportError:
+        return pickle
+
+
+class RemoteTraceback(Exception):
+    """The traceback of an exception raised by a call in the job, set as the
+    __cause__ of the exception (like in concurrent.futures.ProcessPoolExecutor)."""
+
+    def __init__(self, tb):
+        self.tb = tb
+
+    def __str__(self):
+        return f'\n"""\n{self.tb}"""'
+
+
+def _call(payload):
+    """Run one pickled call (fn, args, kwargs), return its pickled outcome:
+    (True, result), or (False, exception, traceback text)."""
+    pickler = _pickler()
+    try:
+        fn, args, kwargs = pickle.loads(payload)
+        return pickler.dumps((True, fn(*args, **kwargs)))
+    except BaseException as e:
+        tb = traceback.format_exc()
+        try:
+            return pickler.dumps((False, e, tb))
+        except Exception:
+            # the exception cannot be pickled, only its description is passed
+            return pickler.dumps((False, RuntimeError(repr(e)), tb))
+
+
+def _write_result(result_dir, index, outcome):
+    """Write the call's outcome atomically, so that a partial file is never read."""
+    path = os.path.join(result_dir, f'{index}.out')
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(outcome)
+    os.replace(path + '.tmp', path)
+
+
+def run_batch(batch_file, result_dir, cpus=1):
+    """Run the calls of the batch file (in a pool of cpus processes), write
+    the outcome of each of them to the result_dir as soon as it is ready."""
+    with open(batch_file, 'rb') as fh:
+        sys_path, calls = pickle.load(fh)
+    # the submitting process's modules are importable here as well
+    sys.path.extend(path for path in sys_path if path not in sys.path)
+    if cpus <= 1 or len(calls) <= 1:
+        for index, payload in calls:
+            _write_result(result_dir, index, _call(payload))
+        return
+    with ProcessPoolExecutor(max_workers=min(cpus, len(calls))) as pool:
+        futures = {pool.submit(_call, payload): index for index, payload in calls}
+        for future in as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # the worker process has died (e.g. out of memory)
+                outcome = _pickler().dumps((False, RuntimeError(f'The call failed: {e!r}'), ''))
+            _write_result(result_dir, futures[future], outcome)
+
+
+class ClusterExecutor(Executor):
+    """Executor of Python callables in cluster jobs, see the module docs.
+    The other keyword arguments (cpus, mem, gpus, engine, queue, name,
+    log_dir etc.) are the parameters of the jobs (see Job); the calls of
+    each job run in a pool of cpus processes.
+    """
+
+    def __init__(self, batch_size=EXECUTOR_BATCH_SIZE, batch_delay=EXECUTOR_BATCH_DELAY,
+                 threads=8, rate=None, work_dir=None, python=sys.executable, **job_params):
+        from qsubmit import Job
+        from qsubmit.broker import SubmissionBroker
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.work_dir = work_dir if work_dir is not None else os.getcwd()
+        self.python = python
+        self.job_params = job_params
+        self.cpus = job_params.get('cpus', Job.DEFAULT_CPUS)
+        self.name = job_params.pop('name', None)
+        self.jobs = []
+        self._dir = tempfile.mkdtemp(prefix='.qsubmit-executor-', dir=self.work_dir)
+        self._broker = SubmissionBroker(threads, rate)
+        self._pickler = _pickler()
+        # call index -> future, until its result is picked up
+        self._futures = {}
+        # the calls of the batch being collected by submit(), and when it was started
+        self._buffer = []
+        self._buffer_time = None
+        # (job, call indexes) of the submitted batches whose jobs are running
+        self._running = []
+        # the batches sent under the lock, submitted by _submit_sent() once it is released
+        self._sent = []
+        self._next_index = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, name='qsubmit-executor', daemon=True)
+        self._collector.start()
+
+    def submit(self, fn, /, *args, **kwargs):
+        """Schedule the call fn(*args, **kwargs), return its Future. The call is
+        sent in a batch with the following ones, see batch_size and batch_delay."""
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot schedule new calls after shutdown')
+            future = self._add_call(fn, args, kwargs)
+            self._buffer.append(self._next_index - 1)
+            if self._buffer_time is None:
+                self._buffer_time = time.monotonic()
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+        self._submit_sent()
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=None):
+        """Return an iterator of fn's results for the items of the iterables,
+        like the built-in map(). Each chunk of chunksize calls (batch_size by
+        default) runs in one job. The results are yielded in order, as soon
+        as they are ready."""
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        chunksize = chunksize or self.batch_size
+        futures = []
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot schedule new calls after shutdown')
+            chunk = []
+            for args in zip(*iterables):
+                futures.append(self._add_call(fn, args, {}))
+                chunk.append(self._next_index - 1)
+                if len(chunk) == chunksize:
+                    self._send(chunk)
+                    chunk = []
+            if chunk:
+                self._send(chunk)
+        self._submit_sent()
+
+        def result_iterator():
+            try:
+                for future in futures:
+                    yield future.result(None if end_time is None else end_time - time.monotonic())
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return result_iterator()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """Send the last batch (or cancel its calls with cancel_futures), and
+        wait for all the results if wait is True. The executor's directory is
+        removed when all the results are in."""
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                for index in self._buffer:
+                    self._futures.pop(index).cancel()
+                self._buffer = []
+            self._flush()
+        self._submit_sent()
+        if wait:
+            self._collector.join()
+
+    def _add_call(self, fn, args, kwargs):
+        future = Future()
+        index = self._next_index
+        self._next_index += 1
+        future.payload = self._pickler.dumps((fn, args, kwargs))
+        self._futures[index] = future
+        return future
+
+    def _flush(self):
+        """Send the batch collected by submit()."""
+        if self._buffer:
+            self._send(self._buffer)
+        self._buffer = []
+        self._buffer_time = None
+
+    def _send(self, indexes):
+        """Write the calls to a batch file and submit the job running them."""
+        from qsubmit import Job
+        futures = [self._futures[index] for index in indexes]
+        # the calls cancelled meanwhile are left out, the others cannot be cancelled anymore
+        calls = [(index, future.payload) for index, future in zip(indexes, futures)
+                 if future.set_running_or_notify_cancel()]
+        for index, future in zip(indexes, futures):
+            del future.payload
+            if future.cancelled():
+                del self._futures[index]
+        if not calls:
+            return
+        batch_file = os.path.join(self._dir, f'batch-{len(self.jobs) + 1}.in')
+        command = [self.python, '-m', 'qsubmit.executor', batch_file, self._dir, '--cpus', str(self.cpus)]
+        name = f'{self.name}-{len(self.jobs) + 1}' if self.name else None
+        try:
+            with open(batch_file, 'wb') as fh:
+                pickle.dump((sys.path, calls), fh)
+            # qsubmit.executor must be importable before the batch's sys.path is read
+            job = Job(command=f'PYTHONPATH={shlex.quote(_PACKAGE_PARENT)}${{PYTHONPATH:+:$PYTHONPATH}} '
+                      + ' '.join(shlex.quote(arg) for arg in command), name=name,
+                      work_dir=self.work_dir, **self.job_params)
+        except Exception as e:
+            for index, _ in calls:
+                self._futures.pop(index).set_exception(e)
+            return
+        self.jobs.append(job)
+        batch = (job, [index for index, _ in calls])
+        self._running.append(batch)
+        self._sent.append(batch)
+
+    def _submit_sent(self):
+        """Submit the jobs of the batches sent by _send(). Called without the
+        lock: the submissions' callbacks take it, and add_done_callback() runs
+        them right away for a submission that has already failed."""
+        with self._lock:
+            sent, self._sent = self._sent, []
+        for batch in sent:
+            self._broker.submit(batch[0]).add_done_callback(lambda f, batch=batch: self._submitted(batch, f))
+
+    def _submitted(self, batch, submission):
+        error = submission.exception()
+        if error is None:
+            return
+        with self._lock:
+            self._forget(batch)
+            futures = [self._futures.pop(index) for index in batch[1]]
+        for future in futures:
+            future.set_exception(error)
+
+    def _forget(self, batch):
+        # by identity, Jobs cannot be compared
+        self._running = [running for running in self._running if running is not batch]
+
+    def _collect(self):
+        """Pick up the results and check the jobs until the executor is shut
+        down and all the results are in. The completion markers are checked
+        every Job.TIME_MARKER_POLL seconds, the batch engine with delays
+        growing from Job.TIME_POLL_MIN to Job.TIME_POLL_DELAY (as in Job.wait())."""
+        from qsubmit import Job
+        delay = Job.TIME_POLL_MIN
+        next_query = time.time()
+        with DirWatcher(self._dir) as watcher:
+            while True:
+                with self._lock:
+                    if self._buffer_time is not None and time.monotonic() >= self._buffer_time + self.batch_delay:
+                        self._flush()
+                    # the jobs' completion markers are removed when they end
+                    if self._shutdown and not self._futures and not self._running:
+                        break
+                self._submit_sent()
+                self._read_results()
+                query = time.time() >= next_query
+                self._check_jobs(query)
+                if query:
+                    next_query = time.time() + delay
+                    delay = min(delay * Job.TIME_POLL_BACKOFF, Job.TIME_POLL_DELAY)
+                timeout = Job.TIME_MARKER_POLL
+                with self._lock:
+                    if self._buffer_time is not None:
+                        timeout = max(0, min(timeout, self._buffer_time + self.batch_delay - time.monotonic()))
+                watcher.wait(timeout)
+        self._broker.shutdown()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def _read_results(self):
+        for fn in os.listdir(self._dir):
+            if not fn.endswith('.out'):
+                continue
+            path = os.path.join(self._dir, fn)
+            with self._lock:
+                future = self._futures.pop(int(fn[:-len('.out')]), None)
+            try:
+                with open(path, 'rb') as fh:
+                    outcome = pickle.load(fh)
+            except Exception as e:
+                # e.g. the result's class cannot be imported here
+                outcome = (False, RuntimeError(f'Cannot read the result: {e!r}'), '')
+            os.remove(path)
+            if future is None:
+                continue
+            if outcome[0]:
+                future.set_result(outcome[1])
+            else:
+                _, error, tb = outcome
+                error.__cause__ = RemoteTraceback(tb)
+                future.set_exception(error)
+
+    def _check_jobs(self, query):
+        """Forget the jobs that have ended, fail their calls without results.
+        The batch engine is only queried if query is True."""
+        from qsubmit import Job
+        with self._lock:
+            running = [batch for batch in self._running if batch[0].submitted]
+        ended = []
+        try:
+            for batch in running:
+                job, indexes = batch
+                if job.read_done_files():
+                    ended.append(batch)
+                # all the jobs are queried at once by the STATE_TRACKER
+                elif query and job.state == Job.FINISH:
+                    ended.append(batch)
+        except (subprocess.CalledProcessError, OSError):
+            # the batch engine is not responding, try again later
+            pass
+        if not ended:
+            return
+        # the results written just before the end
+        self._read_results()
+        for batch in ended:
+            job, indexes = batch
+            with self._lock:
+                self._forget(batch)
+                futures = [self._futures.pop(index) for index in indexes if index in self._futures]
+            for future in futures:
+                future.set_exception(RuntimeError(f'Job {job.name} ({job.jobid}) ended without the result'))
+
+
+if __name__ == '__main__':
+    # run in the jobs submitted by ClusterExecutor
+    ap = ArgumentParser(description='Run a batch of calls of ClusterExecutor')
+    ap.add_argument('batch_file')
+    ap.add_argument('result_dir')
+    ap.add_argument('--cpus', type=int, default=1)
+    args = ap.parse_args()
+    run_batch(args.batch_file, args.result_dir, args.cpus)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Waiting for changes in a directory. Uses Linux inotify (through libc,
+no extra dependencies) where available, so that the waiting process wakes
+up as soon as a file is created there. Inotify does not see changes made
+by other machines on NFS, so the callers must still check the files they
+wait for after each timeout (stat polling).
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+# inotify event masks (see inotify(7))
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+# libc, loaded on the first use (find_library runs subprocesses); False if it cannot be loaded
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def _inotify_watch(path):
+    """Return an inotify file descriptor watching the given directory,
+    or None if inotify is not available."""
+    libc = _get_libc()
+    try:
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except AttributeError:
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DirWatcher:
+    """Waits for changes in the given directory. If inotify is not
+    available (or use_inotify is False), wait() just sleeps for the
+    timeout."""
+
+    def __init__(self, path, use_inotify=True):
+        self.path = path
+        self._fd = _inotify_watch(path) if use_inotify else None
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def wait(self, timeout):
+        """Wait until something changes in the directory, or the timeout
+        (in seconds) passes. Returns True if a change has been seen, False
+        after a timeout (the caller should check the files by itself).
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        # drain all the pending events, we don't care about the details
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,50 +2,704 @@
 
 from qsubmit.qsubmit_script import *
 from qsubmit import Job
+from qsubmit.fswatch import DirWatcher
+from qsubmit.transport import QruncmdServer, parse_address, write_token
+from qsubmit.compress import CODECS, check_codec, open_chunk
+from qsubmit.broker import SubmissionBroker
 from pathlib import Path
 from copy import copy
-from threading import Thread
+from threading import Thread, Event
+from concurrent.futures import wait as wait_futures
 import time
+import io
+import shutil
+import math
+import stat
+import socket
+import statistics
+import json
+import re
+import mmap
+from collections import deque
 
 import sys
 import os
 
+# bounded buffer for copying job outputs when sendfile cannot be used
+COPY_BUFSIZE = 1024*1024
+# how much of the input to read at once (bytes)
+READ_BLOCK = 1024*1024
+# how often to look for jobs of dead workers and for stragglers (seconds)
+LEASE_CHECK_INTERVAL = 5
+# how often to check the backlog in the elastic mode (seconds)
+SCALE_CHECK_INTERVAL = 1
+# how long the queue must be empty before idle workers are retired (seconds)
+SCALE_DOWN_DELAY = 30
+# how often to report that reading the input waits for the workers (seconds)
+IDLE_REPORT_INTERVAL = 60
+# at most this many worker submissions per second (the scheduler's protection),
+# and this many running at once (with the console engine, a submission lasts until the workers end)
+WORKER_SUBMIT_RATE = 1
+WORKER_SUBMIT_THREADS = 4
+
+
+def copy_to_stdout(f):
+    """Stream the binary file f to stdout: zero-copy with sendfile if
+    possible, otherwise with bounded buffered copies."""
+    sys.stdout.flush()
+    offset = 0
+    try:
+        out_fd = sys.stdout.fileno()
+        while True:
+            sent = os.sendfile(out_fd, f.fileno(), offset, COPY_BUFSIZE)
+            if sent == 0:
+                return
+            offset += sent
+    except (OSError, AttributeError, io.UnsupportedOperation):
+        # no sendfile on this platform or for this stdout
+        f.seek(offset)
+        shutil.copyfileobj(f, sys.stdout.buffer, COPY_BUFSIZE)
+        sys.stdout.buffer.flush()
+
+
+def write_output(f, first_line=None):
+    """Copy the binary file f to stdout with bounded buffers. If first_line
+    is given, each line is prefixed by its number (counted from first_line)
+    and a tab. Returns the number of bytes read from f."""
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    size = 0
+    if first_line is None:
+        while True:
+            data = f.read(COPY_BUFSIZE)
+            if not data:
+                break
+            out.write(data)
+            size += len(data)
+    else:
+        for n, line in enumerate(f, first_line):
+            out.write(b"%d\t" % n + line)
+            size += len(line)
+    out.flush()
+    return size
+
+
+class Compression:
+    """The codec for the chunk files in the workdir, and the counts of
+    their bytes before and after compression."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.raw = {'input': 0, 'output': 0}
+        self.compressed = {'input': 0, 'output': 0}
+
+    def open(self, path, mode):
+        return open_chunk(path, mode, self.codec)
+
+    def add(self, kind, raw, compressed):
+        self.raw[kind] += raw
+        self.compressed[kind] += compressed
+
+    def report(self):
+        raw, compressed = sum(self.raw.values()), sum(self.compressed.values())
+        ratio = raw / compressed if compressed else 1
+        mb = lambda n: f"{n / 1e6:.1f} MB"
+        print(f"{self.codec} compression: {mb(self.raw['input'])} of input and {mb(self.raw['output'])} of output chunks "
+              f"spooled as {mb(compressed)}, ratio {ratio:.2f}, saved {mb(raw - compressed)}",file=sys.stderr)
+
+
+class ChunkSizer:
+    """Chooses chunk sizes (in lines) and the number of chunks in flight.
+    With a target time, the size adapts to the per-line processing time
+    measured by the workers, so that one chunk takes about target_time
+    seconds, and chunks get smaller near the end of the input (if its
+    size is known), so that the last chunks don't keep the others waiting.
+    Without a target time, the size is fixed."""
+
+    # at most this change of the chunk size after one measurement
+    MAX_GROWTH = 2
+    # weight of the newest measurement in the per-line time average
+    SMOOTHING = 0.3
+    # upper bound of chunks in flight, in multiples of the number of workers
+    MAX_WINDOW = 8
+
+    def __init__(self, size, workers, target_time=None, max_size=None):
+        self.size = size
+        self.workers = workers
+        self.target_time = target_time
+        self.max_size = max_size or size*1000
+        self.line_time = None  # average processing time of one line
+        self.chunk_time = None  # average processing time of one chunk
+
+    def update(self, seconds, lines):
+        """Take a measurement of one processed chunk."""
+        if not self.target_time or lines == 0:
+            return
+        line_time = max(seconds, 1e-6) / lines
+        if self.line_time is None:
+            self.line_time, self.chunk_time = line_time, seconds
+        else:
+            self.line_time += self.SMOOTHING * (line_time - self.line_time)
+            self.chunk_time += self.SMOOTHING * (seconds - self.chunk_time)
+        wanted = self.target_time / self.line_time
+        self.size = int(min(max(wanted, self.size / self.MAX_GROWTH, 1), self.size * self.MAX_GROWTH, self.max_size))
+
+    def next_size(self, remaining_lines=None):
+        """Size of the next chunk, given the (estimated) number of lines left, if known."""
+        if self.target_time and remaining_lines is not None and remaining_lines < self.size * self.workers:
+            # tail of the input: split it evenly among the workers, but not into tiny pieces
+            return max(1, math.ceil(self.size / 10), math.ceil(remaining_lines / self.workers))
+        return self.size
+
+    @property
+    def max_jobs(self):
+        """How many chunks may be in flight: one running and one waiting for
+        each worker, more if the chunks are faster than the target time."""
+        if not self.target_time or not self.chunk_time:
+            return 2*self.workers
+        queued = math.ceil(self.workers * self.target_time / max(self.chunk_time, 1e-3))
+        return self.workers + min(max(queued, self.workers), (self.MAX_WINDOW - 1) * self.workers)
+
+
+def line_end(buf, pos, end, count, bytes_read=0, lines_read=0):
+    """Position after the count-th newline in buf[pos:end] (bytes or mmap),
+    or -1 if there are fewer. Only about count lines are scanned: the
+    position is estimated from the average line length so far (bytes_read
+    / lines_read) and then corrected by a few find/rfind calls."""
+    line_length = bytes_read / lines_read if lines_read else 80
+    guess = min(end, pos + int(count * line_length))
+    # mmap has no count()
+    found = buf.count(b"\n", pos, guess) if isinstance(buf, bytes) else buf[pos:guess].count(b"\n")
+    cut = guess
+    if found >= count:
+        for _ in range(found - count + 1):
+            cut = buf.rfind(b"\n", pos, cut)
+        return cut + 1
+    for _ in range(count - found):
+        cut = buf.find(b"\n", cut, end)
+        if cut < 0:
+            return -1
+        cut += 1
+    return cut
+
+
+class ChunkReader:
+    """Reads the binary input in large blocks and cuts it into job sections
+    at line ends, with no decoding and no per-line Python objects: the
+    newlines are counted and found by bytes.count/find/rfind (memchr)."""
+
+    def __init__(self, stream, block_size=READ_BLOCK):
+        self.stream = stream
+        self.block_size = block_size
+        self.block = b''
+        self.pos = 0  # start of the unread part of the block
+        self.eof = False
+        self.bytes_read = 0
+        self.lines_read = 0
+
+    def _fill(self):
+        if self.eof:
+            return False
+        # read1 returns what is available, so that a slow pipe does not hold back a section
+        read = getattr(self.stream, 'read1', self.stream.read)
+        self.block = read(self.block_size)
+        self.pos = 0
+        if not self.block:
+            self.eof = True
+        return not self.eof
+
+    def skip(self, size, lines):
+        """Skip the first size bytes (with the given number of lines) of the
+        input, e.g. the part already processed before a resumed run."""
+        try:
+            self.stream.seek(size)
+        except (OSError, AttributeError, io.UnsupportedOperation):
+            # a pipe: read it through
+            left = size
+            while left > 0:
+                data = self.stream.read(min(left, self.block_size))
+                if not data:
+                    break
+                left -= len(data)
+        self.bytes_read = size
+        self.lines_read = lines
+
+    def remaining_lines(self):
+        return remaining_input_lines(self.stream, self.bytes_read, self.lines_read)
+
+    def read(self, max_lines=None, max_bytes=None):
+        """Return the next section (bytes, number of lines) of at most
+        max_lines lines and max_bytes bytes, but at least one line (even if
+        it is longer). An empty section means the end of the input."""
+        parts = []
+        lines = size = 0
+        while max_lines is None or lines < max_lines:
+            if self.pos == len(self.block) and not self._fill():
+                break
+            block, pos = self.block, self.pos
+            # inside a line that began in the previous block
+            partial = bool(parts) and not parts[-1].endswith(b"\n")
+            end = len(block) if max_bytes is None else pos + max(0, min(len(block) - pos, max_bytes - size))
+            cut = -1 if max_lines is None else line_end(block, pos, end, max_lines - lines, self.bytes_read, self.lines_read)
+            if cut < 0 and end < len(block):
+                # the byte limit falls into this block: cut after the last whole line before it
+                cut = block.rfind(b"\n", pos, end) + 1
+                if cut == 0:
+                    if partial and lines:
+                        # the line begun in the previous block does not fit, give it back
+                        data = b"".join(parts)
+                        last = data.rfind(b"\n") + 1
+                        self.block, self.pos = data[last:] + block[pos:], 0
+                        parts, size = [data[:last]], last
+                        break
+                    if parts and not partial:
+                        break
+                    # the line is longer than max_bytes, take it whole
+                    cut = block.find(b"\n", pos) + 1 or len(block)
+            elif cut < 0:
+                cut = len(block)
+            parts.append(block[pos:cut])
+            lines += block.count(b"\n", pos, cut)
+            size += cut - pos
+            self.pos = cut
+            if cut < len(block):
+                break
+        data = b"".join(parts)
+        if data and not data.endswith(b"\n"):
+            lines += 1  # the last line of the input without a newline
+        self.bytes_read += len(data)
+        self.lines_read += lines
+        return data, lines
+
+
+class FileRange:
+    """A section of the input file, passed to the workers as "offset length"
+    so that they read it from the file themselves."""
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        return bytes(self.buf[self.offset:self.offset + self.length])
+
+
+class FileSplitter:
+    """Cuts a regular input file into job sections (FileRange) at line ends,
+    scanning it through mmap: nothing is copied into the workdir and the
+    coordinator stays off the data path. The same interface as ChunkReader."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # an empty file cannot be mapped
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.bytes_read = 0
+        self.lines_read = 0
+
+    def skip(self, size, lines):
+        self.bytes_read = size
+        self.lines_read = lines
+
+    def remaining_lines(self):
+        if not self.lines_read:
+            return None
+        return max(0, self.size - self.bytes_read) * self.lines_read / self.bytes_read
+
+    def read(self, max_lines=None, max_bytes=None):
+        """Return the next section (FileRange, number of lines) of at most
+        max_lines lines and max_bytes bytes, but at least one line. An empty
+        section means the end of the input."""
+        buf, pos, size = self.buf, self.bytes_read, self.size
+        if pos >= size:
+            return FileRange(buf, pos, 0), 0
+        end = size if max_bytes is None else min(size, pos + max_bytes)
+        cut = -1 if max_lines is None else line_end(buf, pos, end, max_lines, self.bytes_read, self.lines_read)
+        if cut >= 0:
+            lines = max_lines
+        else:
+            if end < size:
+                cut = buf.rfind(b"\n", pos, end) + 1
+                if cut == 0:
+                    # the line is longer than max_bytes, take it whole
+                    cut = buf.find(b"\n", pos) + 1 or size
+            else:
+                cut = size
+            lines = buf[pos:cut].count(b"\n")
+            if buf[cut-1:cut] != b"\n":
+                lines += 1  # the last line of the input without a newline
+        self.bytes_read = cut
+        self.lines_read += lines
+        return FileRange(buf, pos, cut - pos), lines
+
+
+def remaining_input_lines(stream, bytes_read, lines_read):
+    """Estimate the number of lines left in the stream if it is a regular
+    file read from its start (from its size and the average line length),
+    None otherwise."""
+    try:
+        st = os.fstat(stream.fileno())
+        if not lines_read or not stat.S_ISREG(st.st_mode):
+            return None
+        return max(0, st.st_size - bytes_read) * lines_read / bytes_read
+    except (OSError, AttributeError, io.UnsupportedOperation):
+        return None
+
+
+class Manifest:
+    """Checkpoint of a run in its workdir (manifest.jsonl), so that it can
+    be resumed if qruncmd dies: the command line, and for each job section
+    its input byte and line range and output file when it is submitted,
+    and when its output has been printed. Records are appended and synced
+    to disk one by one."""
+
+    def __init__(self, workdir):
+        self.path = f"{workdir}/manifest.jsonl"
+        self._file = None
+
+    def _append(self, **record):
+        if self._file is None:
+            self._file = open(self.path, "a")
+        print(json.dumps(record), file=self._file, flush=True)
+        os.fsync(self._file.fileno())
+
+    def start(self, argv):
+        self._append(event="start", argv=argv)
+
+    def submitted(self, index, start, end, first_line, lines):
+        self._append(event="submitted", job=index, start=start, end=end, first_line=first_line, lines=lines, output=f"job_{index}.out")
+
+    def flushed(self, index):
+        self._append(event="flushed", job=index)
+
+    def input_over(self):
+        self._append(event="eof")
+
+    def load(self):
+        """Return the command line of the run, its job sections (index ->
+        the submitted record, with 'flushed' True or False) and whether
+        the whole input has been read."""
+        argv, jobs, eof = None, {}, False
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn by the crash
+                if record["event"] == "start" and argv is None:
+                    argv = record["argv"]
+                elif record["event"] == "submitted":
+                    jobs[record["job"]] = dict(record, flushed=False)
+                elif record["event"] == "flushed" and record["job"] in jobs:
+                    jobs[record["job"]]["flushed"] = True
+                elif record["event"] == "eof":
+                    eof = True
+        return argv, jobs, eof
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def prepare_resume(workdir, jobs):
+    """Prepare the workdir of an interrupted run for resuming it: remove
+    the poison pills, the workers' partial outputs and the files of the
+    sections not in the manifest (or already printed), and return the claimed sections to pending/ (if
+    their old workers are still alive, the first result wins). Returns the
+    highest worker ID of the old run, the new workers get higher ones."""
+    last_worker = 0
+    for fn in os.listdir(workdir):
+        m = re.match(r"(?:worker-|out-fifo-worker-)([0-9]+)", fn)
+        if m:
+            last_worker = max(last_worker, int(m.group(1)))
+        elif fn in ("slow-poison-pill", "fast-poison-pill"):
+            os.remove(f"{workdir}/{fn}")
+    for fn in os.listdir(f"{workdir}/claimed"):
+        name = fn.partition("@")[0]
+        if os.path.exists(f"{workdir}/pending/{name}"):
+            os.remove(f"{workdir}/claimed/{fn}")
+        else:
+            os.rename(f"{workdir}/claimed/{fn}", f"{workdir}/pending/{name}")
+    for d in (workdir, f"{workdir}/pending"):
+        for fn in os.listdir(d):
+            if re.match(r"job_[0-9]+(\.out|\.ok\.tmp)@", fn):
+                # a worker's partial output or stats, the section is computed again
+                os.remove(f"{d}/{fn}")
+                continue
+            m = re.match(r"job_([0-9]+)(\.out|\.ok)?$", fn)
+            if m and (int(m.group(1)) not in jobs or jobs[int(m.group(1))]["flushed"]):
+                os.remove(f"{d}/{fn}")
+            elif m and not m.group(2) and d == workdir:
+                # written and recorded, but not published
+                os.rename(f"{d}/{fn}", f"{workdir}/pending/{fn}")
+    return last_worker
+
+
 class QruncmdJob:
 
-    def __init__(self, i, workdir):
+    def __init__(self, i, workdir, compression=None, manifest=None):
         self.index = i
-
-        self.buffer = []
+        self.compression = compression
+        self.manifest = manifest
 
         self.fname = f"{workdir}/job_{i}"
+        # the job input is published to pending/, the worker claiming it renames it
+        # to claimed/job_{i}@{worker ID}
+        self.pending_fname = f"{workdir}/pending/job_{i}"
+        self.claimed_dir = f"{workdir}/claimed"
+        # when the job was first seen claimed, and whether it has been duplicated
+        self.claimed_at = None
+        self.speculated = False
+
+
+    def submit(self, data, lines, first_line=1, offset=0):
+        """Publish the job section (bytes) for the workers. first_line and
+        offset are the number of its first line and its byte offset in the input."""
+        self.lines = lines
+        self.first_line = first_line
+        if isinstance(data, FileRange):
+            with open(self.fname,"w") as f:
+                print(data.offset, data.length, file=f)
+        elif self.compression is None:
+            with open(self.fname,"wb") as f:
+                f.write(data)
+        else:
+            with self.compression.open(self.fname,"wb") as f:
+                f.write(data)
+            self.compression.add('input', len(data), os.path.getsize(self.fname))
+        if self.manifest is not None:
+            self.manifest.submitted(self.index, offset, offset + len(data), first_line, lines)
+        # publish the complete input at once
+        os.rename(self.fname, self.pending_fname)
 
+    def is_completed(self):
+        return os.path.exists(self.fname+".ok")
 
-    def insert(self, line):
-        self.buffer.append(line)
-
-    def submit(self):
-        lock = self.fname+".lock"
-        try:
-            os.mkdir(lock)
-        except FileExistsError:
-            print("Something weird happens. There is already a locked job.")
-            raise
+    def stats(self):
+        """Processing wall time and number of lines, as measured by the worker."""
+        with open(self.fname+".ok","r") as f:
+            seconds, lines = f.read().split()
+        return float(seconds), int(lines)
+
+    def flush(self, tag_index=False):
+        """Print the output, with the input line numbers if tag_index, and clean up."""
+        if self.compression is None and not tag_index:
+            with open(self.fname+".out","rb") as f:
+                copy_to_stdout(f)
+        else:
+            compressed = os.path.getsize(self.fname+".out")
+            opener = open if self.compression is None else self.compression.open
+            with opener(self.fname+".out","rb") as f:
+                raw = write_output(f, self.first_line if tag_index else None)
+            if self.compression is not None:
+                self.compression.add('output', raw, compressed)
+        if self.manifest is not None:
+            self.manifest.flushed(self.index)
+        # the input may be claimed by more workers (speculative duplicates), or still pending
+        for fn in os.listdir(self.claimed_dir):
+            if fn.startswith(f"job_{self.index}@"):
+                os.remove(f"{self.claimed_dir}/{fn}")
+        if os.path.exists(self.pending_fname):
+            os.remove(self.pending_fname)
+        # a late duplicate worker may remove them as well, when it sees the job flushed
+        for fn in (self.fname+".out", self.fname+".ok"):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+class QruncmdSocketJob(QruncmdJob):
+    """Job section passed to the workers through the socket transport
+    instead of the workdir."""
+
+    def __init__(self, i, server):
+        self.index = i
+        self.server = server
+        self.claimed_at = None
+        self.speculated = False
 
-        with open(self.fname,"w") as f:
-            print("".join(self.buffer),end="",file=f)
-        os.rmdir(lock)
-        del self.buffer
+    def submit(self, data, lines, first_line=1, offset=0):
+        self.lines = lines
+        self.first_line = first_line
+        self.server.publish(self.index, data.read() if isinstance(data, FileRange) else data)
 
     def is_completed(self):
-        return os.path.exists(self.fname+".ok")
+        return self.index in self.server.results
+
+    def stats(self):
+        seconds, lines, _ = self.server.results[self.index]
+        return seconds, lines
+
+    def flush(self, tag_index=False):
+        _, _, output = self.server.results.pop(self.index)
+        write_output(io.BytesIO(output), self.first_line if tag_index else None)
+
+
+class SpoolLeaseChecker:
+    """Finds jobs claimed by dead workers in the workdir and requeues them.
+    A worker (cluster job) is dead when its worker-{i}.end file exists, or when its
+    heartbeat file worker-{i}.alive has not been touched for lease_timeout
+    seconds (judged by the coordinator's clock, so that the clocks of the
+    nodes don't matter). Optionally, the oldest unfinished job is duplicated
+    when it runs speculate times longer than usual and there is nothing else
+    to do; the first result wins."""
+
+    def __init__(self, workdir, lease_timeout, speculate=None):
+        self.workdir = workdir
+        self.lease_timeout = lease_timeout
+        self.speculate = speculate
+        # worker ID -> (last seen heartbeat mtime, when it was seen to change)
+        self.heartbeats = {}
+
+    def is_alive(self, worker, now):
+        # workers {i}.1, {i}.2, ... of one cluster job share its heartbeat and end marker
+        worker = worker.split(".")[0]
+        if os.path.exists(f"{self.workdir}/worker-{worker}.end"):
+            return False
+        try:
+            mtime = os.stat(f"{self.workdir}/worker-{worker}.alive").st_mtime
+        except FileNotFoundError:
+            return True  # starting up
+        if self.heartbeats.get(worker, (None,))[0] != mtime:
+            self.heartbeats[worker] = (mtime, now)
+        return now - self.heartbeats[worker][1] < self.lease_timeout
+
+    def check(self, current_jobs, chunk_time):
+        now = time.time()
+        claimed = {}
+        for fn in os.listdir(f"{self.workdir}/claimed"):
+            name, _, worker = fn.partition("@")
+            claimed.setdefault(name, []).append(worker)
+        for j in current_jobs:
+            workers = claimed.get(f"job_{j.index}", [])
+            if workers and j.claimed_at is None:
+                j.claimed_at = now
+            for worker in workers:
+                if j.is_completed() or self.is_alive(worker, now):
+                    continue
+                try:
+                    os.rename(f"{self.workdir}/claimed/job_{j.index}@{worker}", j.pending_fname)
+                    j.claimed_at = None
+                    print(f"worker {worker} is dead, requeueing job {j.index}",file=sys.stderr)
+                except FileNotFoundError:
+                    pass
+        if not self.speculate or not current_jobs or not chunk_time:
+            return
+        j = current_jobs[0]
+        if (not j.speculated and j.claimed_at is not None and not j.is_completed()
+                and now - j.claimed_at > self.speculate * chunk_time
+                and not os.listdir(f"{self.workdir}/pending")):
+            try:
+                worker = claimed[f"job_{j.index}"][0]
+                os.link(f"{self.workdir}/claimed/job_{j.index}@{worker}", j.pending_fname)
+                j.speculated = True
+                print(f"job {j.index} is a straggler, running a duplicate",file=sys.stderr)
+            except (KeyError, IndexError, OSError):
+                pass
+
+
+class WorkerPool:
+    """Starts the workers with worker IDs first..last by submitting the Job
+    made by make_job(first, last), through a SubmissionBroker, so that the
+    input processing is not blocked and the scheduler is not flooded. In the elastic mode (min_workers < max_workers),
+    check() scales the number of workers to the backlog: more workers are
+    submitted when there are more than scale_up_backlog queued jobs per
+    worker, and the idle workers above min_workers are retired when the
+    queue has been empty for SCALE_DOWN_DELAY seconds -- each gets its own
+    poison pill (or an END frame with the socket transport). Each worker
+    (cluster job) runs procs command instances."""
+
+    def __init__(self, workdir, min_workers, max_workers, make_job, scale_up_backlog=2, server=None, first_id=1, procs=1):
+        self.workdir = workdir
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.make_job = make_job
+        self.scale_up_backlog = scale_up_backlog
+        self.server = server
+        self.first_id = first_id
+        self.procs = procs
+        self.started = first_id - 1
+        self.retired = set()
+        self.empty_since = None
+        self.broker = SubmissionBroker(threads=WORKER_SUBMIT_THREADS, rate=WORKER_SUBMIT_RATE, print_cmd=sys.stderr)
+        self.submissions = []
+
+    @property
+    def elastic(self):
+        return self.min_workers < self.max_workers
+
+    def start(self, count):
+        first, last = self.started + 1, self.started + count
+        self.started = last
+        def submitted(future):
+            if future.exception() is not None:
+                print(f"workers {first}-{last} could not be started: {future.exception()}",file=sys.stderr)
+            else:
+                print(f"workers {first}-{last} have started (submitted in {future.result():.2f} s)",file=sys.stderr)
+        job = self.make_job(first, last)
+        future = self.broker.submit(job)
+        future.add_done_callback(submitted)
+        self.submissions.append(future)
+
+    def live(self):
+        """IDs of the workers that are submitted (maybe still waiting in
+        the cluster queue), not ended and not retired."""
+        return [i for i in range(self.first_id, self.started + 1)
+                if i not in self.retired and not os.path.exists(f"{self.workdir}/worker-{i}.end")]
+
+    def check(self, queued, running):
+        """Scale the workers, given the numbers of jobs waiting for a worker and being processed."""
+        live = self.live()
+        wanted = min(self.max_workers, math.ceil(queued / (self.scale_up_backlog * self.procs)))
+        if wanted > len(live):
+            print(f"{queued} jobs queued for {len(live)} workers, starting {wanted - len(live)} more",file=sys.stderr)
+            self.start(wanted - len(live))
+        if queued:
+            self.empty_since = None
+            return
+        now = time.time()
+        if self.empty_since is None:
+            self.empty_since = now
+        if now - self.empty_since < SCALE_DOWN_DELAY:
+            return
+        idle = min((len(live) * self.procs - running) // self.procs, len(live) - self.min_workers)
+        # the youngest workers go first
+        for i in live[::-1][:max(idle, 0)]:
+            print(f"retiring idle worker {i}",file=sys.stderr)
+            self.retire(i)
+        self.empty_since = now
+
+    def retire(self, i):
+        self.retired.add(i)
+        if self.server is not None:
+            for _ in range(self.procs):
+                self.server.retire()
+        else:
+            Path(f"{self.workdir}/poison-pill-{i}").touch()
+
+    def join(self):
+        wait_futures(self.submissions)
+        self.broker.shutdown()
+
+
+class ResultEvent(Event):
+    """Wakes up the flushing loop when a result comes over the socket
+    (the counterpart of DirWatcher for the workdir)."""
+
+    def wait(self, timeout):
+        res = super().wait(timeout)
+        self.clear()
+        return res
+
+    def close(self):
+        pass
 
-    def flush(self):
-        with open(self.fname+".out","r") as f:
-            sys.stdout.write(f.read())
-        sys.stdout.flush()
-        os.remove(self.fname)
-        os.remove(self.fname+".out")
-        os.remove(self.fname+".ok")
 
 def temp_workdir_fname(pref):
     import string
@@ -62,113 +716,270 @@ def main():
     # ...plus following ones
     ap.add_argument('--workdir', type=str, default=None, help="workdir, default is qruncmd-workdir-XXXXXXXXX where X stands for random letter")
     ap.add_argument('--jobs',"--workers", type=int, default=5, help="How many workers (qsubmit jobs) to start. The workers concurrently wait for jobs (stdin sections saved to workdir), claim them, process and return the outputs.")
+    ap.add_argument('--procs-per-worker', type=int, default=None, help="How many instances of the command to run in each worker (qsubmit job), each one processing its own job sections. Default is the number of CPUs of the job (--cpus).")
+    ap.add_argument('--min-workers', type=int, default=None, help="Elastic mode: start with this many workers (default 1) and retire the idle ones down to this number when there are no jobs waiting. Used with --max-workers, instead of --jobs.")
+    ap.add_argument('--max-workers', type=int, default=None, help="Elastic mode: start more workers, up to this number, when there are more than SCALE_UP_BACKLOG jobs waiting per worker.")
+    ap.add_argument('--scale-up-backlog', type=float, default=2, help="Elastic mode: how many waiting jobs per worker trigger starting more workers.")
     ap.add_argument('-s','--size', type=int, help="How many lines in one job section.", default=500)
+    ap.add_argument('--size-bytes', type=int, default=None, help="Cut the job sections by size in bytes instead of by lines: each section has at most this many bytes (but at least one line).")
+    ap.add_argument('--target-time', type=float, default=None, help="Adaptive chunk sizing: grow or shrink the job sections (starting at SIZE lines) so that processing one takes about this many seconds, and shrink them near the end of the input.")
+    ap.add_argument('--input', type=str, default=None, help="Read the input from this file instead of stdin. The job sections are then only byte ranges of the file, which the workers read by themselves, so the file must be visible to them (e.g. on a shared disk).")
+    ap.add_argument('--transport', choices=['spool', 'socket'], default='spool', help="How to pass the job sections to the workers and back: through files in the workdir (spool, default), or over TCP connections from the workers to qruncmd (socket).")
+    ap.add_argument('--compress', choices=sorted(CODECS), default=None, help="Compress the job sections and their outputs in the workdir (spool transport only). lz4 and zstd need the lz4 and zstandard Python packages on all the nodes.")
+    ap.add_argument('--listen', type=str, default=None, help="HOST:PORT to listen on with the socket transport, the workers connect to it. Default is this machine's hostname and a free port.")
+    ap.add_argument('--lease-timeout', type=float, default=120, help="Requeue the job of a worker whose heartbeat has not been seen for this many seconds (or which has ended).")
+    ap.add_argument('--speculate', type=float, default=None, help="Speculative re-execution: when the oldest unfinished job has been running SPECULATE times longer than the median job and no job is waiting, run a duplicate of it on another worker (the first result wins).")
+    ap.add_argument('--unordered', action='store_true', help="Print the outputs of the job sections as soon as they are completed, not in the input order, so that a slow section does not hold back the others.")
+    ap.add_argument('--tag-index', action='store_true', help="Prefix each output line with the number of its input line (from 1) and a tab, e.g. to restore the order of --unordered outputs with sort -n.")
+    ap.add_argument('--resume', type=str, metavar='WORKDIR', default=None, help="Resume an interrupted run (spool transport only) from its workdir, with the same options: skip the sections that have been printed, print or requeue the others, and continue with the rest of the input, which must be the same on stdin (unless it had been read completely).")
+    ap.add_argument('--poll-interval', type=float, default=0.2, help="How often (in seconds) to check the workdir for completed jobs when inotify does not notice them (e.g. on NFS).")
     args = ap.parse_args()
+    resumed = None
+    if args.resume is not None:
+        try:
+            argv, resumed, resumed_eof = Manifest(args.resume).load()
+        except FileNotFoundError:
+            ap.error(f"--resume: there is no manifest in {args.resume}")
+        args = ap.parse_args(argv + ['--workdir', args.resume])
+    elif args.transport == "spool":
+        argv = sys.argv[1:]
+    if args.transport != "spool" and resumed is not None:
+        ap.error("--resume: only the runs with the spool transport can be resumed")
+    if args.size_bytes is not None and args.target_time is not None:
+        ap.error("--size-bytes and --target-time cannot be used together")
+    if args.compress is not None:
+        try:
+            check_codec(args.compress)
+        except ImportError as e:
+            ap.error(f"--compress {args.compress}: {e}")
 
     batch_size = args.size
+    size_bytes = args.size_bytes
     workdir = args.workdir
     if workdir is None:
         workdir = temp_workdir_fname("qruncmd-workdir")
     workers = args.jobs
+    min_workers = workers
+    if args.max_workers is not None:
+        workers = args.max_workers
+        min_workers = min(args.min_workers or 1, workers)
+    scale_up_backlog = args.scale_up_backlog
+    procs = args.procs_per_worker or args.cpus
+    compression = Compression(args.compress) if args.compress is not None and args.transport == "spool" else None
+    poll_interval = args.poll_interval
+    input_file = args.input
+    unordered = args.unordered
+    tag_index = args.tag_index
+    sizer = ChunkSizer(batch_size, workers * procs, args.target_time)
+    transport = args.transport
+    listen = args.listen
+    lease_timeout = args.lease_timeout
+    speculate = args.speculate
+    del args.target_time
+    del args.transport
+    del args.listen
+    del args.compress
+    del args.lease_timeout
+    del args.speculate
     del args.workdir
     del args.size
+    del args.size_bytes
     del args.jobs
+    del args.min_workers
+    del args.max_workers
+    del args.scale_up_backlog
+    del args.procs_per_worker
+    del args.poll_interval
+    del args.input
+    del args.unordered
+    del args.tag_index
+    del args.resume
+    # the workers are never cached
+    del args.cache
+    del args.inputs
+    del args.outputs
 
     if not os.path.isdir(workdir):
         os.mkdir(workdir)
-    else:
+    elif resumed is None:
         print(f"Workdir {workdir} already exists, maybe it should be cleared first?",file=sys.stderr)
+    os.makedirs(f"{workdir}/pending", exist_ok=True)
+    os.makedirs(f"{workdir}/claimed", exist_ok=True)
+
+    # the job sections are checkpointed only with the spool transport, the socket one keeps them in memory
+    manifest = None
+    last_worker = 0
+    if transport == "spool":
+        manifest = Manifest(workdir)
+        if resumed is None:
+            manifest.start(argv)
+        else:
+            last_worker = prepare_resume(workdir, resumed)
+            done = sum(r["flushed"] for r in resumed.values())
+            print(f"resuming {workdir}: {done} sections printed, {len(resumed) - done} to be completed",file=sys.stderr)
+
+    server = None
+    connect = ""
+    # how qwrapcmd should read the job files in the workdir
+    spool_opts = ""
+    if compression is not None:
+        spool_opts += f" --compress {compression.codec}"
+    if input_file is not None and transport == "spool":
+        spool_opts += f" --input {os.path.abspath(input_file)}"
+    if transport == "socket":
+        host, port = parse_address(listen) if listen else (socket.gethostname(), 0)
+        result_event = ResultEvent()
+        server = QruncmdServer(host, port, on_result=result_event.set, lease_timeout=lease_timeout, speculate=speculate)
+        # only the workers with the token may connect, they read it from the workdir
+        write_token(f"{workdir}/socket-token", server.token)
+        server.start()
+        connect = f"--connect {host}:{server.port} --token-file {workdir}/socket-token"
+        print(f"listening on {host}:{server.port}",file=sys.stderr)
 
     ######### start workers
 
 
 
-    def start_workers():
-        started_workers = 0
+    def worker_job(first, last):
         cmd = " ".join(args.command)
-        for i in range(workers):
+        # all the workers are submitted as one job array, the task index is the worker ID
+        i = "$QSUBMIT_TASK_ID"
+        def pipeline(w):
             # stdbuf avoids stucking data between the pipes
-            wrapcmd = f"mkfifo {workdir}/out-fifo-worker-{i} && stdbuf -o0 python3 -m qsubmit.qwrapcmd {workdir} {workdir}/out-fifo-worker-{i} | stdbuf -o0 -i0 -e0 {cmd} > {workdir}/out-fifo-worker-{i} ; touch {workdir}/worker-{i}.end"
-
-            v = copy(args)
-            v.command = wrapcmd
-            if v.name is None or v.name == "qsubmit":
-                v.name = f"qruncmd-{i}"
-            if v.logdir is None:
-                v.logdir = workdir
-
-            # run qsubmit Job
-            run_script(v)
-            started_workers += 1
-            if started_workers % 10 == 0:
-                time.sleep(1)
-        print("all the workers have started",file=sys.stderr)
-
-    if workers > 10:
-        starting_thread = Thread(target=start_workers)
-        starting_thread.start()
-    else:
-        start_workers()
-        starting_thread = None
-
+            return f"mkfifo {workdir}/out-fifo-worker-{w} && stdbuf -o0 python3 -m qsubmit.qwrapcmd {workdir} {workdir}/out-fifo-worker-{w} --worker-id {w} --group {i} {connect}{spool_opts} | stdbuf -o0 -i0 -e0 {cmd} > {workdir}/out-fifo-worker-{w}"
+        if procs == 1:
+            wrapcmd = f"{pipeline(i)} ; touch {workdir}/worker-{i}.end"
+        else:
+            # the instances {i}.1, {i}.2, ... share the heartbeat and the end marker of the job
+            wrapcmd = f"for p in $(seq 1 {procs}); do ( {pipeline(i + '.$p')} ) & done ; wait ; touch {workdir}/worker-{i}.end"
+
+        v = copy(args)
+        v.command = wrapcmd
+        if v.name is None or v.name == "qsubmit":
+            v.name = "qruncmd"
+        if v.logdir is None:
+            v.logdir = workdir
+        v.array = f"{first}-{last}"
+        return make_job(v)
+
+    pool = WorkerPool(workdir, min_workers, workers, worker_job, scale_up_backlog, server, first_id=last_worker + 1, procs=procs)
+    pool.start(min_workers)
 
     ######### 
 
     def slowpoison():
         # this will make the workers to complete the pending jobs and stop
+        if server is not None:
+            server.finish()
+            return
         d = f"{workdir}/slow-poison-pill"
         Path(d).touch()
 
-    max_jobs = 2*workers
-
     current_jobs = []
 
     global iseof
     iseof = False  # True when the input is over
 
+    reader = ChunkReader(sys.stdin.buffer) if input_file is None else FileSplitter(input_file)
+    first_jobid = 0
+    if resumed:
+        for i, record in sorted(resumed.items()):
+            if not record["flushed"]:
+                j = QruncmdJob(i, workdir, compression, manifest)
+                j.lines, j.first_line = record["lines"], record["first_line"]
+                current_jobs.append(j)
+        last = resumed[max(resumed)]
+        first_jobid = last["job"] + 1
+        if not resumed_eof:
+            reader.skip(last["end"], last["first_line"] + last["lines"] - 1)
+    if resumed is not None and resumed_eof:
+        iseof = True
+        slowpoison()
+
     ######## processing loop
 
     global stop_everything
 
     stop_everything = False
 
+    # set by the flushing loop whenever a job slot frees up
+    slot_freed = Event()
+
     def submitting_loop():
-        jobid = 0
+        jobid = first_jobid
         global iseof
+        # the idle state is reported at most once per IDLE_REPORT_INTERVAL, not on every wake-up
+        last_idle_report = None
         while not stop_everything:
-            if not iseof and len(current_jobs) < max_jobs:
-                j = QruncmdJob(jobid, workdir)
-                jobid += 1
-                for i in range(batch_size):
-                    line = sys.stdin.readline()
-                    if line != "":
-                        j.insert(line)
-                    else:
-                        iseof = True
-                        slowpoison()
-                        break
-                current_jobs.append(j)
-                j.submit()
+            if not iseof and len(current_jobs) < sizer.max_jobs:
+                if size_bytes is not None:
+                    data, lines = reader.read(max_bytes=size_bytes)
+                else:
+                    data, lines = reader.read(sizer.next_size(reader.remaining_lines()))
+                if data:
+                    j = QruncmdJob(jobid, workdir, compression, manifest) if server is None else QruncmdSocketJob(jobid, server)
+                    jobid += 1
+                    j.submit(data, lines, reader.lines_read - lines + 1, reader.bytes_read - len(data))
+                    current_jobs.append(j)
+                else:
+                    iseof = True
+                    if manifest is not None:
+                        manifest.input_over()
+                    slowpoison()
             else:
-                print(f"submitting loop is idle, {len(current_jobs)} < {max_jobs}",file=sys.stderr)
-                time.sleep(1)
+                if last_idle_report is None or time.time() - last_idle_report >= IDLE_REPORT_INTERVAL:
+                    print(f"submitting loop is idle, {len(current_jobs)} jobs in flight (at most {sizer.max_jobs})",file=sys.stderr)
+                    last_idle_report = time.time()
+                slot_freed.wait(1)
+                slot_freed.clear()
         print("submitting completed",file=sys.stderr)
 
     def flushing_loop():
         global stop_everything
+        # completed jobs are noticed via inotify at once, or by the stat checks every poll_interval
+        watcher = DirWatcher(workdir) if server is None else result_event
+        # dead workers' jobs are requeued, stragglers possibly duplicated
+        lease_checker = SpoolLeaseChecker(workdir, lease_timeout, speculate) if server is None else server
+        last_check = last_scale_check = time.time()
+        chunk_times = deque(maxlen=50)
         while not stop_everything:
-            while current_jobs and current_jobs[0].is_completed():
-                j = current_jobs.pop(0)
-                j.flush()
+            while True:
+                if unordered:
+                    j = next((j for j in current_jobs if j.is_completed()), None)
+                else:
+                    j = current_jobs[0] if current_jobs and current_jobs[0].is_completed() else None
+                if j is None:
+                    break
+                current_jobs.remove(j)
+                slot_freed.set()
+                seconds, lines = j.stats()
+                sizer.update(seconds, lines)
+                chunk_times.append(seconds)
+                j.flush(tag_index)
                 print(f"flushing job {j.index}",file=sys.stderr)
 
+            if time.time() - last_check > LEASE_CHECK_INTERVAL:
+                lease_checker.check(list(current_jobs), statistics.median(chunk_times) if chunk_times else None)
+                last_check = time.time()
+
+            if pool.elastic and time.time() - last_scale_check > SCALE_CHECK_INTERVAL:
+                if server is None:
+                    queued = len(os.listdir(f"{workdir}/pending"))
+                else:
+                    queued = server.queued()
+                pool.check(queued, sum(not j.is_completed() for j in current_jobs) - queued)
+                last_scale_check = time.time()
+
             if iseof and not current_jobs:
                 stop_everything = True
+                slot_freed.set()
                 break
-            time.sleep(1)
+            watcher.wait(poll_interval)
+        watcher.close()
         print("flushing completed",file=sys.stderr)
 
             # TODO: check the error status of the jobs, make sure there is no error...
+            # (dead workers are handled by the lease checker, but a failing command isn't)
 
     submit_thread = Thread(target=submitting_loop)
     submit_thread.start()
@@ -176,8 +987,13 @@ def main():
     flushing_loop()
 
     submit_thread.join()
-    if starting_thread is not None:
-        starting_thread.join()
+    pool.join()
+    if compression is not None:
+        compression.report()
+    if server is not None:
+        server.close()
+    if manifest is not None:
+        manifest.close()
 
 if __name__ == "__main__":
     main()
@@ -3,7 +3,8 @@ from qsubmit import Job
 import sys
 import os
 
-def run_script(args):
+def make_job(args):
+    """Create the Job given by the command-line arguments (without submitting it)."""
 
     # adjust the arguments to the internal API
     args = vars(args)
@@ -27,13 +28,22 @@ def run_script(args):
             print(f"Logdir {logdir} could not be created due to permission error. Exiting.", file=sys.stderr)
             sys.exit(1)
 
+    # only the result cache reads the completion marker later, nobody waits for the job
+    args['done_marker'] = args.get('cache', False)
+
     if 'command' in args and len(args['command']) == 1:
         args['command'] = args['command'][0]
 
-    job = Job(**args)
+    return Job(**args)
+
+
+def run_script(args):
+    job = make_job(args)
     job.submit(print_cmd=sys.stderr)
     if job.jobid:
         print("Submitted job ID: %s" % job.jobid, file=sys.stderr)
+    elif job.cached:
+        print("Not submitted, the cached result is up to date", file=sys.stderr)
 
 def qsubmit_argparser(name="qsubmit",desc="Batch engine script submission wrapper"):
     ap = ArgumentParser(prog=name,description=desc)
@@ -49,6 +59,14 @@ def qsubmit_argparser(name="qsubmit",desc="Batch engine script submission wrappe
     ap.add_argument('-l', '-logdir', '--logdir', help='Directory where the log file will be stored')
     ap.add_argument('-w', '--hold', '--wait', help='Hold until jobs with the given IDs are completed',
                     nargs='*', default=[], type=int)
+    ap.add_argument('-t', '--array', help='Submit a job array with the given task range (e.g. 1-100), '
+                    'the command may use the task index in $QSUBMIT_TASK_ID')
+    ap.add_argument('--cache', action='store_true', help='Do not submit the job if the same job has succeeded '
+                    'before and its input and output files have not changed since then')
+    ap.add_argument('--cache-input', dest='inputs', action='append', metavar='FILE',
+                    help='Input file of the job, checked by --cache (may be repeated)')
+    ap.add_argument('--cache-output', dest='outputs', action='append', metavar='FILE',
+                    help='Output file of the job, checked by --cache (may be repeated)')
     ap.add_argument('command', nargs='*', help='The arguments for the command to be run')
 
     return ap
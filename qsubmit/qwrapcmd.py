@@ -4,92 +4,265 @@
 
 # Usage:
 #
-# python3 -m qsubmit.qwrapcmd {workdir} {workdir}/out-fifo-worker-{i} | stdbuf -oL {cmd} > {workdir}/out-fifo-worker-{i}
+# python3 -m qsubmit.qwrapcmd {workdir} {workdir}/out-fifo-worker-{i} [--connect HOST:PORT --token-file FILE] | stdbuf -oL {cmd} > {workdir}/out-fifo-worker-{i}
 
 # - cmd is a command (worker) that receives stdin and produces one line of output for each input line
 # - qwrapcmd.py is a worker wrapper: 
-#   - waits for a job, acquires and locks it
-#   - sends the job input from job_{j} file to cmd behind a pipe on stdout
+#   - waits for a job and claims it by renaming pending/job_{j} to claimed/job_{j}@{i} (atomic, so only one worker succeeds)
+#   - sends the job input from claimed/job_{j}@{i} file to cmd behind a pipe on stdout
+#     (with --compress, the job files are decompressed and the output compressed on the fly;
+#     with --input, the job files are just "offset length" and the input is read from that file)
 #   - collects output of cmd from the named pipe out-fifo-worker-{i}
-#   - it saves the output to job_{j}.out file, markes the job as OK by touching job_{j}.ok file, and releases the lock
-#   - dies on a poison pill
+#   - it saves the output to job_{j}.out@{i} file, links it to job_{j}.out (the first result of a job wins if it is
+#     processed more times) and markes the job as OK by creating job_{j}.ok file,
+#     which contains the processing wall time in seconds and the number of lines (for adaptive chunk sizing)
+#   - touches worker-{g}.alive every HEARTBEAT_INTERVAL seconds, so that qruncmd can requeue jobs of dead workers
+#   - dies on a poison pill: the slow one for all the workers when the input is over,
+#     or poison-pill-{g} when qruncmd retires this idle worker (elastic mode)
+# - g is the worker group: with qruncmd --procs-per-worker, one cluster job runs more workers {g}.1, {g}.2, ...,
+#   which share the heartbeat and the poison pill; otherwise it is just the worker ID i
+# - with --connect, the jobs are not taken from the workdir, but requested from qruncmd over a socket,
+#   and the outputs are sent back the same way (see qsubmit/transport.py); the worker authenticates
+#   with the token of the run from --token-file
 
 import sys
 import os
 from pathlib import Path
 import time
 import threading
+import io
+import re
+import socket
+from argparse import ArgumentParser
 
-workdir = sys.argv[1]
-fifofn = sys.argv[2]
+from qsubmit.fswatch import DirWatcher
+from qsubmit import transport
+from qsubmit.compress import CODECS, open_chunk
+
+ap = ArgumentParser(prog="qwrapcmd")
+ap.add_argument('workdir')
+ap.add_argument('fifo')
+ap.add_argument('--connect', help="HOST:PORT of qruncmd with the socket transport")
+ap.add_argument('--token-file', help="file with the token of the qruncmd run, sent to it with --connect")
+ap.add_argument('--compress', choices=sorted(CODECS), default=None, help="codec of the job files in the workdir")
+ap.add_argument('--input', help="the input file of qruncmd --input, the job files are \"offset length\" ranges of it")
+ap.add_argument('--group', default=None, help="ID of the cluster job running this worker, for the heartbeat file and the poison pill shared with the other workers there (default: the worker ID)")
+ap.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}", help="ID of this worker, used in the names of the claimed jobs and the heartbeat file")
+args = ap.parse_args()
+
+workdir = args.workdir
+fifofn = args.fifo
 job_pref = "job"
+pending_dir = f"{workdir}/pending"
+claimed_dir = f"{workdir}/claimed"
+
+worker_id = args.worker_id
+group = args.group or worker_id
+
+# sleeping between unsuccessful claims grows from min to max
+IDLE_MIN = 0.01
+IDLE_MAX = 0.5
+# seconds between heartbeats, must be well below qruncmd's --lease-timeout
+HEARTBEAT_INTERVAL = 10
 
 out = open(fifofn,"r")
 
 #global lines
 
 #lines = 0
-def process_job(inname):
+def process_job(name, inf, outf):
+    """Send the lines of inf to the command, write its output to outf."""
     global complete
     complete = False
     lines = 0
     def reading():
         global complete
         received = 0
-        with open(inname+".out","w") as outf:
-            while True:
-                if received < lines:
-                    r = out.readline()
-                    print(r,end="",file=outf)
-                    received += 1
-                elif received == lines:
-                    if complete:
-                        break
-                else:
-                    time.sleep(0.1)
+        while True:
+            if received < lines:
+                r = out.readline()
+                print(r,end="",file=outf)
+                received += 1
+            elif received == lines:
+                if complete:
+                    break
+            else:
+                time.sleep(0.1)
         print("done",file=sys.stderr)
     t = threading.Thread(target=reading)
     t.start()
 
-    print(f"Processing {inname}",file=sys.stderr)
-    with open(inname,"r") as f:
-        for line in f:
-            print(line,end="",flush=True)
-            lines += 1
-            if lines % 100 == 0:
-                print("line",lines,file=sys.stderr)
+    print(f"Processing {name}",file=sys.stderr)
+    for line in inf:
+        print(line,end="",flush=True)
+        lines += 1
+        if lines % 100 == 0:
+            print("line",lines,file=sys.stderr)
     complete = True
     print(f"waiting for {lines} lines",file=sys.stderr)
     t.join()
+    return lines
+
+
+def job_index(fn):
+    return int(fn.replace(job_pref+"_",""))
 
 
-def sortjobs(jobs):
-    x = [ int(j.replace(job_pref+"_","")) for j in jobs ]
-    x = sorted(x)
-    return [ job_pref+"_" + str(i) for i in x ]
+def claim(index):
+    """Try to claim the job with the given index, True on success."""
+    try:
+        os.rename(f"{pending_dir}/{job_pref}_{index}", f"{claimed_dir}/{job_pref}_{index}@{worker_id}")
+        return True
+    except FileNotFoundError:
+        # not published yet, or another worker was faster
+        return False
 
 
-while not os.path.exists(f"{workdir}/fast-poison-pill"):  # to be implemented in qruncmd.py
-    iswork = False
+def claim_next(cursor):
+    """Claim the next job: first try the expected next index (one rename
+    in the common case), then the lowest of the few currently pending ones.
+    Returns the claimed job index, or None."""
+    if claim(cursor):
+        return cursor
+    for index in sorted(job_index(fn) for fn in os.listdir(pending_dir) if re.match(job_pref+r"_[0-9]+$", fn)):
+        if claim(index):
+            return index
+    return None
 
-    jobs = []
-    for fn in os.listdir(workdir):
-        if fn.startswith(job_pref) and not fn.endswith("lock") and not fn.endswith("ok") and not fn.endswith("out"):
-            jobs.append(fn)
-    for fn in sortjobs(jobs):
-        dfn = f"{workdir}/{fn}"
-        lock = f"{dfn}.lock"
-        ok = f"{dfn}.ok"
-        if os.path.exists(dfn) and not os.path.exists(ok) and not os.path.isdir(lock):
+
+def open_job_input(fn):
+    """The input lines of the claimed job file: its content, or with --input,
+    the range of the input file it describes."""
+    if args.input is None:
+        return io.TextIOWrapper(open_chunk(fn, "rb", args.compress))
+    with open(fn, "r") as f:
+        offset, length = map(int, f.read().split())
+    with open(args.input, "rb") as f:
+        f.seek(offset)
+        return io.TextIOWrapper(io.BytesIO(f.read(length)))
+
+
+def heartbeat(beat):
+    """Call beat() every HEARTBEAT_INTERVAL seconds, in a daemon thread."""
+    def loop():
+        while True:
             try:
-                os.mkdir(lock)
-            except FileExistsError:
-                continue
-            process_job(dfn)
-            Path(ok).touch()
-            os.rmdir(lock)
-            iswork = True
-    if not iswork and os.path.exists(f"{workdir}/slow-poison-pill"):
-        break
-    time.sleep(0.01)
+                beat()
+            except OSError:  # e.g. the connection is closed
+                return
+            time.sleep(HEARTBEAT_INTERVAL)
+    threading.Thread(target=loop, daemon=True).start()
+
+
+def is_flushed(index):
+    """The job's input is gone from the workdir, i.e. qruncmd has flushed its output."""
+    name = f"{job_pref}_{index}"
+    return not os.path.exists(f"{pending_dir}/{name}") and not any(fn.startswith(name+"@") for fn in os.listdir(claimed_dir))
+
+
+def publish_result(index, outname, seconds, lines):
+    """Link the output to job_{j}.out and create job_{j}.ok, unless the job
+    has been completed by another worker meanwhile (it was requeued or
+    speculatively duplicated)."""
+    dfn = f"{workdir}/{job_pref}_{index}"
+    try:
+        if is_flushed(index):
+            return
+        os.link(outname, f"{dfn}.out")
+    except FileExistsError:
+        print(f"{job_pref}_{index} was completed by another worker",file=sys.stderr)
+        return
+    except FileNotFoundError:
+        # removed by a resumed qruncmd, which has requeued the job
+        return
+    finally:
+        try:
+            os.remove(outname)
+        except FileNotFoundError:
+            pass
+    # the .ok file appears with the stats already in it
+    try:
+        with open(f"{dfn}.ok.tmp@{worker_id}","w") as f:
+            print(f"{seconds:.3f} {lines}",file=f)
+        os.rename(f"{dfn}.ok.tmp@{worker_id}", f"{dfn}.ok")
+    except FileNotFoundError:
+        # removed by a resumed qruncmd, which has requeued the job
+        return
+    # qruncmd may have flushed the job (another result) between the check above and the link,
+    # then nobody would remove these files; if it has flushed this result, it has been printed already
+    if is_flushed(index):
+        for fn in (f"{dfn}.out", f"{dfn}.ok"):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+
+def spool_loop():
+    """Take the jobs from the workdir until the poison pill."""
+    cursor = 0
+    idle = IDLE_MIN
+    heartbeat(lambda: Path(f"{workdir}/worker-{group}.alive").touch())
+    watcher = DirWatcher(pending_dir)
+    while not os.path.exists(f"{workdir}/fast-poison-pill"):  # to be implemented in qruncmd.py
+        # checked before claiming: all the jobs are published before the pill
+        poisoned = os.path.exists(f"{workdir}/slow-poison-pill")
+        index = claim_next(cursor)
+        if index is not None:
+            outname = f"{workdir}/{job_pref}_{index}.out@{worker_id}"
+            start = time.time()
+            with open_job_input(f"{claimed_dir}/{job_pref}_{index}@{worker_id}") as inf, \
+                    io.TextIOWrapper(open_chunk(outname, "wb", args.compress)) as outf:
+                lines = process_job(f"{job_pref}_{index}", inf, outf)
+            publish_result(index, outname, time.time() - start, lines)
+            cursor = index + 1
+            idle = IDLE_MIN
+            continue
+        if poisoned or os.path.exists(f"{workdir}/poison-pill-{group}"):
+            break
+        # new jobs wake us up at once if inotify works here, otherwise back off
+        watcher.wait(idle)
+        idle = min(idle * 2, IDLE_MAX)
+    watcher.close()
+
+
+def socket_loop(address):
+    """Request jobs from qruncmd over the socket until there are no more."""
+    try:
+        conn = socket.create_connection(transport.parse_address(address))
+    except OSError as e:
+        # e.g. qruncmd has already finished
+        print(f"Cannot connect to {address}: {e}",file=sys.stderr)
+        return
+    transport.set_nodelay(conn)
+    # the token must come first, qruncmd rejects the connection otherwise
+    token = transport.read_token(args.token_file) if args.token_file else ""
+    transport.send_frame(conn, transport.AUTH, payload=token.encode())
+    # the heartbeat frames are sent from another thread
+    send_lock = threading.Lock()
+    def send_frame(*frame):
+        with send_lock:
+            transport.send_frame(conn, *frame)
+    heartbeat(lambda: send_frame(transport.HEARTBEAT))
+    with conn:
+        while True:
+            send_frame(transport.REQUEST)
+            try:
+                kind, index, payload = transport.recv_frame(conn)
+            except ConnectionError:
+                print(f"The connection to {address} was closed (wrong token?)",file=sys.stderr)
+                break
+            if kind == transport.END:
+                break
+            start = time.time()
+            outf = io.StringIO()
+            lines = process_job(f"{job_pref}_{index}", io.StringIO(payload.decode("utf-8")), outf)
+            stats = f"{time.time() - start:.3f} {lines}\n"
+            send_frame(transport.DONE, index, (stats + outf.getvalue()).encode("utf-8"))
+
+
+if args.connect:
+    socket_loop(args.connect)
+else:
+    spool_loop()
 out.close()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Cache of successful job results, so that a job identical to one that
+has already succeeded is not queued again (opt-in, see Job's cache).
+
+An entry is addressed by a hash of the job specification (the command or
+code, resources, engine, working directory, and the paths of the declared
+input and output files). It records the contents of the input and output
+files after the job succeeded, as their sizes, modification times and
+SHA-256 digests: the result is up to date if all the files are the same
+(by size and time, or by content if the time has changed).
+
+The entries are small JSON files in the user's cache directory (one per
+job specification). Old entries are evicted by age, and the oldest ones
+when the cache grows too large. A job that is submitted but not waited for
+(e.g. from the command line) leaves a pending entry with its completion
+markers, which is completed by the next lookup if the job has succeeded.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from qsubmit.config import cache_path
+
+
+# entries older than this (in seconds) are evicted
+RESULT_MAX_AGE = 30 * 24 * 3600
+# the oldest entries are evicted when all of them together take more bytes
+RESULT_MAX_BYTES = 64 * 1024 * 1024
+# how often (in seconds) to scan the cache for entries to evict
+RESULT_EVICT_INTERVAL = 3600
+# how much of a file to hash at once
+HASH_BLOCK = 1024 * 1024
+
+
+def file_digest(path):
+    """SHA-256 hex digest of the file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def spec_key(spec):
+    """The address of a job specification (a JSON-serializable dictionary)."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+class ResultCache:
+    """Results of successful jobs, by their specification keys (see spec_key),
+    stored in a directory (by default results/ in the user's cache directory).
+    """
+
+    def __init__(self, path=None, max_age=RESULT_MAX_AGE, max_bytes=RESULT_MAX_BYTES):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def lookup(self, key, files):
+        """Return True if there is a result for the key and the given files
+        (inputs and outputs) are the same as they were after that job."""
+        try:
+            with open(self._entry_path(key), 'r', encoding='UTF-8') as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if 'pending' in entry:
+            return self._complete(key, files, entry['pending'])
+        if entry.get('time', 0) < time.time() - self.max_age or set(entry.get('files', {})) != set(files):
+            return False
+        return all(self._unchanged(path, *entry['files'][path]) for path in files)
+
+    def store(self, key, files, jobid=None):
+        """Record a successful result of the job with the given key, with
+        the current contents of the files. Files that do not exist (e.g. an
+        output that was not produced) prevent caching."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='UTF-8') as fh:
+                previous = json.load(fh).get('files', {})
+        except (OSError, ValueError):
+            previous = {}
+        try:
+            recorded = {fn: self._stat(fn, previous.get(fn)) for fn in files}
+        except OSError:
+            return False
+        return self._write(key, {'time': time.time(), 'jobid': jobid, 'files': recorded})
+
+    def _write(self, key, entry):
+        path = self._entry_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='UTF-8') as fh:
+                json.dump(entry, fh)
+            os.replace(tmp_path, path)
+            self._maybe_evict()
+        except OSError:
+            # the cache is just an optimization
+            return False
+        return True
+
+    def submitted(self, key, done_files, jobid=None):
+        """Record a pending result of the job with the given key: it is
+        successful when all the done_files (completion markers) contain 0."""
+        self._write(key, {'time': time.time(), 'pending': {'done_files': done_files, 'jobid': jobid}})
+
+    def _complete(self, key, files, pending):
+        """Store the pending result if the job has succeeded (its completion
+        markers are removed then), return True if it is stored."""
+        try:
+            statuses = []
+            for done_file in pending['done_files']:
+                with open(done_file, 'r', encoding='UTF-8') as fh:
+                    statuses.append(int(fh.read().strip()))
+        except (OSError, ValueError):
+            # still running (an empty marker is not written completely yet), or it has died
+            return False
+        if any(statuses) or not self.store(key, files, pending.get('jobid')):
+            return False
+        for done_file in pending['done_files']:
+            self._remove(done_file)
+        return True
+
+    def evict(self):
+        """Remove the entries older than max_age, and the oldest ones above max_bytes."""
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self._get_path()):
+            for fn in filenames:
+                if fn.startswith('.') or fn.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_mtime < now - self.max_age:
+                    self._remove(path)
+                else:
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _get_path(self):
+        return self.path or cache_path('results')
+
+    def _entry_path(self, key):
+        # subdirectories by the key prefix keep the directories small
+        return os.path.join(self._get_path(), key[:2], key)
+
+    def _maybe_evict(self):
+        """Evict at most once per RESULT_EVICT_INTERVAL (in any process)."""
+        stamp = os.path.join(self._get_path(), '.evicted')
+        try:
+            if os.stat(stamp).st_mtime > time.time() - RESULT_EVICT_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        with open(stamp, 'w'):
+            pass
+        self.evict()
+
+    @staticmethod
+    def _stat(path, previous=None):
+        """[size, modification time, digest] of the file; the digest is not
+        computed again if the size and time are the same as previously."""
+        st = os.stat(path)
+        if previous and previous[:2] == [st.st_size, st.st_mtime_ns]:
+            return previous
+        return [st.st_size, st.st_mtime_ns, file_digest(path)]
+
+    @staticmethod
+    def _unchanged(path, size, mtime_ns, digest):
+        try:
+            st = os.stat(path)
+            if st.st_size != size:
+                return False
+            # only files touched since then are hashed
+            return st.st_mtime_ns == mtime_ns or file_digest(path) == digest
+        except OSError:
+            return False
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Socket transport between qruncmd (the coordinator) and qwrapcmd (the workers),
+# an alternative to passing the job sections through files in the shared workdir.
+#
+# The workers connect to the coordinator and exchange length-prefixed frames
+# (kind, job index, payload length, payload):
+#   - worker: AUTH (the secret token of the run) as the first frame, otherwise the coordinator
+#                                 closes the connection; the token is passed to the workers in
+#                                 a file readable only by the user (see write_token)
+#   - worker: REQUEST          -> coordinator: CHUNK (index, input lines) or END (no more input,
+#                                 or the worker is retired)
+#   - worker: DONE (index, "seconds lines\n" + output lines)
+#   - worker: HEARTBEAT, regularly from another thread
+# A worker only gets a new section when it asks for it, which is the flow control:
+# the coordinator reads its input only as far as the in-flight window allows.
+# Sections of workers that disconnect or stop sending heartbeats are requeued.
+
+import hmac
+import os
+import secrets
+import socket
+import struct
+import threading
+import time
+import sys
+from collections import deque
+
+REQUEST = b'R'
+CHUNK = b'C'
+END = b'E'
+DONE = b'D'
+HEARTBEAT = b'H'
+AUTH = b'A'
+
+HEADER = struct.Struct('!cqQ')
+
+# an unauthenticated connection is closed after this many seconds without the AUTH frame
+AUTH_TIMEOUT = 30
+# longest token accepted in the AUTH frame (bytes)
+MAX_TOKEN_SIZE = 1024
+
+
+def send_frame(conn, kind, index=-1, payload=b''):
+    conn.sendall(HEADER.pack(kind, index, len(payload)) + payload)
+
+
+def recv_exact(conn, size):
+    buf = bytearray()
+    while len(buf) < size:
+        data = conn.recv(min(size - len(buf), 1024*1024))
+        if not data:
+            raise ConnectionError("connection closed")
+        buf += data
+    return bytes(buf)
+
+
+def recv_frame(conn):
+    """Return (kind, index, payload) of the next frame."""
+    kind, index, size = HEADER.unpack(recv_exact(conn, HEADER.size))
+    return kind, index, recv_exact(conn, size)
+
+
+def set_nodelay(conn):
+    # frames are small and answered at once, don't let Nagle's algorithm delay them
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def write_token(path, token):
+    """Write the token to a new file readable only by the user."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+
+
+def read_token(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+class QruncmdServer:
+    """Coordinator side of the socket transport. Job sections are published
+    by publish(), handed to the workers on request, and their results are
+    collected in self.results (index -> (seconds, lines, output)).
+
+    The sections held by a worker are requeued when it disconnects or its
+    heartbeats stop for lease_timeout seconds. Optionally, the oldest
+    unfinished section is handed out once more when it runs speculate
+    times longer than usual and there is nothing else to do; the first
+    result wins.
+
+    Only the workers that send the token (random by default) in their first
+    frame are served."""
+
+    def __init__(self, host='', port=0, on_result=None, lease_timeout=120, speculate=None, token=None):
+        self.token = token or secrets.token_hex(32)
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.on_result = on_result
+        self.lease_timeout = lease_timeout
+        self.speculate = speculate
+        self.results = {}
+        self._pending = deque()
+        self._eof = False
+        self._cond = threading.Condition()
+        # index -> [data, connections holding it, when it was first handed out]
+        self._inflight = {}
+        # indexes of the sections with a result
+        self._done = set()
+        # connection -> time of its last frame
+        self._last_seen = {}
+        # how many idle workers should get END although the input is not over
+        self._retire = 0
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def publish(self, index, data):
+        with self._cond:
+            self._pending.append((index, data))
+            self._cond.notify()
+
+    def finish(self):
+        """No more sections will be published, the workers may stop."""
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def retire(self):
+        """Let one idle worker stop (the first one asking for a section when there is none)."""
+        with self._cond:
+            self._retire += 1
+            self._cond.notify()
+
+    def queued(self):
+        """Number of sections waiting for a worker."""
+        with self._cond:
+            return len(self._pending)
+
+    def close(self):
+        self.finish()
+        self.sock.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:  # closed
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def check(self, current_jobs, chunk_time):
+        """Requeue the sections of workers with expired heartbeats, and
+        duplicate the oldest section (current_jobs[0]) if it is a straggler."""
+        now = time.time()
+        with self._cond:
+            for conn, last_seen in list(self._last_seen.items()):
+                if now - last_seen > self.lease_timeout:
+                    print("a worker is silent, requeueing its jobs",file=sys.stderr)
+                    self._release(conn)
+            if not self.speculate or not current_jobs or not chunk_time or self._pending:
+                return
+            index = current_jobs[0].index
+            if index in self._inflight and not current_jobs[0].speculated:
+                data, _, handed_out = self._inflight[index]
+                if now - handed_out > self.speculate * chunk_time:
+                    print(f"job {index} is a straggler, running a duplicate",file=sys.stderr)
+                    current_jobs[0].speculated = True
+                    self._pending.appendleft((index, data))
+                    self._cond.notify()
+
+    def _release(self, conn):
+        """Requeue the unfinished sections held only by the given connection."""
+        self._last_seen.pop(conn, None)
+        for index, (data, holders, _) in sorted(self._inflight.items(), reverse=True):
+            if conn in holders:
+                holders.discard(conn)
+                if not holders:
+                    del self._inflight[index]
+                    self._pending.appendleft((index, data))
+                    self._cond.notify()
+
+    def _next_chunk(self, conn):
+        with self._cond:
+            while not self._pending and not self._eof and not self._retire:
+                self._cond.wait()
+            if not self._pending:
+                if not self._eof:
+                    self._retire -= 1
+                return None
+            index, data = self._pending.popleft()
+            inflight = self._inflight.setdefault(index, [data, set(), time.time()])
+            inflight[1].add(conn)
+            return index, data
+
+    def _authenticate(self, conn):
+        """Check the AUTH frame, the first one of each connection."""
+        conn.settimeout(AUTH_TIMEOUT)
+        kind, _, size = HEADER.unpack(recv_exact(conn, HEADER.size))
+        if kind != AUTH or size > MAX_TOKEN_SIZE:
+            return False
+        token = recv_exact(conn, size)
+        conn.settimeout(None)
+        return hmac.compare_digest(token, self.token.encode())
+
+    def _serve(self, conn):
+        set_nodelay(conn)
+        with conn:
+            try:
+                if not self._authenticate(conn):
+                    print("rejecting a connection without the token",file=sys.stderr)
+                    return
+            except (ConnectionError, OSError):
+                return
+            try:
+                while True:
+                    kind, index, payload = recv_frame(conn)
+                    with self._cond:
+                        self._last_seen[conn] = time.time()
+                    if kind == REQUEST:
+                        chunk = self._next_chunk(conn)
+                        if chunk is None:
+                            send_frame(conn, END)
+                            return
+                        send_frame(conn, CHUNK, *chunk)
+                    elif kind == DONE:
+                        with self._cond:
+                            # the first result wins
+                            if index in self._done:
+                                continue
+                            self._done.add(index)
+                            self._inflight.pop(index, None)
+                        stats, _, output = payload.partition(b"\n")
+                        seconds, lines = stats.split()
+                        self.results[index] = (float(seconds), int(lines), output)
+                        if self.on_result is not None:
+                            self.on_result()
+            except (ConnectionError, OSError):
+                return
+            finally:
+                with self._cond:
+                    self._release(conn)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""Workflows: graphs of Jobs connected by their dependencies, submitted
+with one call and tracked together.
+
+    prep = Job(command='./prepare.sh')
+    wf = Workflow()
+    wf.add(prep)
+    for i in range(100):
+        wf.add(Job(command=f'./train.sh {i}'), after=prep)
+    wf.submit()
+    wf.wait()
+
+The jobs are submitted in topological waves (all the jobs whose
+dependencies have been submitted at once, through a SubmissionBroker),
+so that each job can hold on its dependencies' job IDs. Where the engine
+supports it (Slurm's afterok), the jobs are held until their dependencies
+succeed, so that the scheduler never starts a job after a failed one, even
+if nobody waits for the workflow. All of them are then tracked by the
+single poller of the STATE_TRACKER. When a job fails, the jobs depending
+on it (directly or not) are cancelled, or skipped if they have not been
+submitted yet.
+"""
+
+import asyncio
+import subprocess
+
+from qsubmit import Job, as_completed, delete_jobs
+from qsubmit.broker import SubmissionBroker
+
+
+class Workflow:
+    """A graph of jobs, see the module docs. The state of each job is
+    one of the WAITING (not submitted yet), SUBMITTED, DONE, FAILED
+    (the job, or its submission), CANCELLED and SKIPPED (because of
+    a failed dependency), see state().
+    """
+
+    WAITING = 'waiting'
+    SUBMITTED = 'submitted'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    SKIPPED = 'skipped'
+
+    def __init__(self, jobs=(), threads=16, rate=None):
+        """The jobs (and the jobs they depend on) are added to the workflow.
+        The submission runs in the given number of threads, at most rate
+        jobs per second if set (see SubmissionBroker)."""
+        self.threads = threads
+        self.rate = rate
+        self.jobs = []
+        # id(job) -> state (Jobs are not hashable)
+        self._states = {}
+        # id(job) -> the jobs depending on it
+        self._dependents = {}
+        # id(job) -> the error of a failed submission
+        self.errors = {}
+        for job in jobs:
+            self.add(job)
+
+    def add(self, job, after=None):
+        """Add the job to the workflow, depending on the given job(s), if any.
+        The jobs it depends on are added as well. Return the job."""
+        known = self._job_dependencies(job) if id(job) in self._states else None
+        if after is not None:
+            job.add_dependency(after)
+        if known is None:
+            self.jobs.append(job)
+            self._states[id(job)] = self.WAITING
+            self._dependents[id(job)] = []
+            known = []
+        # the dependencies are appended, only the new ones are added here
+        for dep in self._job_dependencies(job)[len(known):]:
+            self.add(dep)
+            self._dependents[id(dep)].append(job)
+        return job
+
+    def state(self, job):
+        return self._states[id(job)]
+
+    def waves(self):
+        """Check the graph and return the jobs in topological waves: each
+        job is in the wave after the last one of its dependencies."""
+        levels = {}
+        for job in self.jobs:
+            for dep in self._job_dependencies(job):
+                if dep.engine_name != job.engine_name:
+                    raise ValueError(f'Job {job.name} cannot depend on job {dep.name} of another engine')
+            if not job.submitted and not (job.code or job.command):
+                raise ValueError(f'Interactive job {job.name} cannot be a part of a workflow')
+
+        def level(job, path):
+            if id(job) in levels:
+                return levels[id(job)]
+            if id(job) in path:
+                raise ValueError(f'Cyclic dependency of job {job.name}')
+            levels[id(job)] = max([level(dep, path | {id(job)}) + 1
+                                   for dep in self._job_dependencies(job)], default=0)
+            return levels[id(job)]
+
+        waves = []
+        for job in self.jobs:
+            if not job.submitted:
+                waves.extend([] for _ in range(level(job, frozenset()) + 1 - len(waves)))
+                waves[levels[id(job)]].append(job)
+        return waves
+
+    def submit(self, print_cmd=None):
+        """Submit all the (not yet submitted) jobs of the workflow. The jobs
+        depending on a job whose submission failed are skipped."""
+        waves = self.waves()
+        for job in self.jobs:
+            if job.submitted and self.state(job) == self.WAITING:
+                self._states[id(job)] = self.SUBMITTED
+        with SubmissionBroker(self.threads, self.rate, print_cmd=print_cmd) as broker:
+            for wave in waves:
+                for job in wave:
+                    job.hold_ok = True
+                futures = [(job, broker.submit(job)) for job in wave if self.state(job) == self.WAITING]
+                for job, future in futures:
+                    try:
+                        future.result()
+                    except (subprocess.CalledProcessError, OSError, RuntimeError) as e:
+                        self.errors[id(job)] = e
+                        self._fail(job)
+                        continue
+                    self._states[id(job)] = self.SUBMITTED
+                    # synchronous engines (console) have run the job already, cached jobs need not run
+                    if (job.cached or job.engine.get('synchronous')) and job.read_done_files():
+                        self._finished(job, job.exit_status)
+
+    def wait(self):
+        """Wait until all the jobs of the workflow are finished (or cancelled,
+        or skipped). Raise an exception if any of them has failed."""
+        asyncio.run(self.wait_async())
+
+    async def wait_async(self):
+        """Asynchronous version of wait()."""
+        running = [job for job in self.jobs if self.state(job) == self.SUBMITTED]
+        loop = asyncio.get_running_loop()
+        async for job in as_completed(running):
+            if self.state(job) != self.SUBMITTED:
+                continue
+            try:
+                # the accounting report is retrieved by a blocking command
+                exit_status = await loop.run_in_executor(None, lambda: job.exit_status)
+            except RuntimeError:
+                # ended without the completion marker and there is no report
+                exit_status = None
+            self._finished(job, exit_status)
+        failed = [job for job in self.jobs if self.state(job) == self.FAILED]
+        if failed:
+            raise RuntimeError(f'{len(failed)} job(s) of the workflow did not finish successfully: '
+                               + ', '.join(job.name for job in failed[:10]))
+
+    def summary(self):
+        """Return the numbers of jobs in each state."""
+        counts = {}
+        for job in self.jobs:
+            counts[self.state(job)] = counts.get(self.state(job), 0) + 1
+        return counts
+
+    def _finished(self, job, exit_status):
+        if exit_status == 0:
+            self._states[id(job)] = self.DONE
+        else:
+            self._fail(job)
+
+    def _fail(self, job):
+        """Mark the job as failed, cancel or skip all the jobs depending on it."""
+        self._states[id(job)] = self.FAILED
+        to_cancel = []
+        stack = list(self._dependents[id(job)])
+        while stack:
+            dep = stack.pop()
+            if self.state(dep) == self.WAITING:
+                self._states[id(dep)] = self.SKIPPED
+            elif self.state(dep) == self.SUBMITTED:
+                self._states[id(dep)] = self.CANCELLED
+                to_cancel.append(dep)
+            else:
+                continue
+            stack.extend(self._dependents[id(dep)])
+        try:
+            delete_jobs(to_cancel)
+        except subprocess.CalledProcessError:
+            # some of them may have finished meanwhile
+            pass
+
+    @staticmethod
+    def _job_dependencies(job):
+        """The Job objects the job depends on (not the plain job IDs)."""
+        return [dep for dep in job._dependencies if isinstance(dep, Job)]
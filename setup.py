@@ -12,5 +12,10 @@ setup(
     license='Apache 2.0',
     scripts=['bin/qsubmit','bin/qruncmd'],
     packages=find_packages(),
+    extras_require={
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+        'cloudpickle': ['cloudpickle'],
+    },
 )
 
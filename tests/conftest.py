@@ -0,0 +1,38 @@
+import os
+import stat
+
+import pytest
+
+
+FAKE_SBATCH = '''#!/bin/bash
+# runs the job script (from stdin) right away, each task of --array=FIRST-LAST separately
+array=1-1
+for arg in "$@"; do case "$arg" in --array=*) array="${arg#--array=}";; esac; done
+script=$(mktemp "$FAKE_SLURM_DIR/job.XXXXXX")
+cat > "$script"; chmod +x "$script"
+for task in $(seq "${array%-*}" "${array#*-}"); do
+    SLURM_ARRAY_TASK_ID=$task "$script" > /dev/null 2>&1
+done
+echo "Submitted batch job $$"
+'''
+
+
+def _write_exe(path, text):
+    with open(path, 'w') as fh:
+        fh.write(text)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+@pytest.fixture
+def fake_slurm(tmp_path, monkeypatch):
+    """sbatch that runs the jobs synchronously, squeue and sacct that know no jobs;
+    the qsubmit cache is in tmp_path."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir / 'sbatch', FAKE_SBATCH)
+    for cmd in ('squeue', 'sacct', 'sinfo'):
+        _write_exe(bin_dir / cmd, '#!/bin/sh\n')
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_SLURM_DIR', str(bin_dir))
+    monkeypatch.setenv('QSUBMIT_CACHE_DIR', str(tmp_path / 'cache'))
+    return bin_dir
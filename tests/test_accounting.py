@@ -0,0 +1,29 @@
+import time
+
+from qsubmit import ENGINES
+from qsubmit.accounting import ReportCache
+
+from conftest import _write_exe
+
+
+SACCT_LINE = '{jobid}|{name}|COMPLETED|{status}:0|node1|2026-01-01T10:00:00|2026-01-01T10:01:00|00:01:00|'
+
+
+def test_reports_of_reused_job_ids_are_not_trusted(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir / 'sacct', '#!/bin/sh\necho "%s"\n' % SACCT_LINE.format(jobid=42, name='new', status=1))
+    monkeypatch.setenv('PATH', f'{bin_dir}:/usr/bin:/bin')
+    cache = ReportCache(str(tmp_path / 'reports.json'))
+    # an earlier job with the same ID, cached before the new one was submitted
+    cache._save('ufal/slurm', {'42': {'jobid': '42', 'name': 'old', 'state': 'COMPLETED',
+                                      'exit_status': 0, 'cached_time': time.time() - 60}})
+    submit_time = time.time() - 30
+    reports = cache.fetch('ufal/slurm', ENGINES['slurm'], {'42': ('new', submit_time)})
+    assert reports['42']['exit_status'] == 1
+    # cached now, nothing else is known at the other cluster
+    _write_exe(bin_dir / 'sacct', '#!/bin/sh\n')
+    assert cache.fetch('ufal/slurm', ENGINES['slurm'], {'42': ('new', submit_time)})['42']['exit_status'] == 1
+    assert cache.fetch('robotarium/slurm', ENGINES['slurm'], {'42': ('new', submit_time)}) == {}
+    # a job with another name
+    assert cache.fetch('ufal/slurm', ENGINES['slurm'], {'42': ('other', submit_time)}) == {}
@@ -0,0 +1,36 @@
+import threading
+from concurrent.futures import Future
+
+from qsubmit.broker import SubmissionBroker
+from qsubmit.executor import ClusterExecutor
+
+
+def test_failed_submissions_fail_the_calls(tmp_path, monkeypatch):
+    # the submissions have failed when they are returned
+    def submit(self, job):
+        future = Future()
+        future.set_exception(OSError('sbatch: not found'))
+        return future
+
+    monkeypatch.setattr(SubmissionBroker, 'submit', submit)
+    monkeypatch.setenv('QSUBMIT_CACHE_DIR', str(tmp_path / 'cache'))
+    errors = []
+
+    def run():
+        try:
+            with ClusterExecutor(engine='slurm', work_dir=str(tmp_path)) as executor:
+                list(executor.map(abs, [1, 2, 3], chunksize=1))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+
+
+def test_map(fake_slurm, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    with ClusterExecutor(engine='slurm', work_dir=str(tmp_path)) as executor:
+        assert list(executor.map(abs, [-1, -2, -3], chunksize=2)) == [1, 2, 3]
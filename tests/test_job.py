@@ -0,0 +1,54 @@
+import glob
+import os
+
+from qsubmit import Job
+
+from conftest import _write_exe
+
+
+def test_code_job_array_writes_task_markers(fake_slurm, tmp_path):
+    job = Job(code='pass', engine='slurm', work_dir=str(tmp_path), array='1-3')
+    job.submit()
+    assert job.read_done_files()
+    assert job.exit_status == 0
+    # all the task markers have been found and removed
+    assert glob.glob(os.path.join(str(tmp_path), '.qsubmit-*')) == []
+
+
+def test_grun_job_is_running_after_submit(tmp_path, monkeypatch):
+    # grun submits with -nowait, the job is listed by qstat until it ends
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir / 'grun', '#!/bin/sh\necho 4242\n')
+    _write_exe(bin_dir / 'qstat', '#!/bin/sh\necho "4242 0.5 job user r 01/01/2026 all.q@node1.cluster 1"\n')
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('QSUBMIT_CACHE_DIR', str(tmp_path / 'cache'))
+    job = Job(command='sleep 100', engine='grun', work_dir=str(tmp_path))
+    job.submit()
+    assert job.state == 'r'
+    assert not job.read_done_files()
+
+
+def test_code_job_array_task_params(fake_slurm, tmp_path):
+    code = ("with open(f'task-{os.environ[\"QSUBMIT_TASK_ID\"]}.txt', 'w') as fh:\n"
+            "    fh.write(os.environ['QSUBMIT_TASK_PARAM'])")
+    job = Job(code=code, engine='slurm', work_dir=str(tmp_path))
+    job.submit_array(['a', 'b'])
+    assert job.read_done_files()
+    assert job.exit_status == 0
+    assert (tmp_path / 'task-1.txt').read_text() == 'a'
+    assert (tmp_path / 'task-2.txt').read_text() == 'b'
+
+
+def test_sge_job_array_tasks_log_separately(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    _write_exe(bin_dir / 'qsub', '#!/bin/sh\ncat > /dev/null\necho "Your job-array 77.1-2:1 has been submitted"\n')
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('QSUBMIT_CACHE_DIR', str(tmp_path / 'cache'))
+    job = Job(command='true', engine='sge', work_dir=str(tmp_path), name='w')
+    job.submit_array(2)
+    assert "-o './w.o$JOB_ID.$TASK_ID'" in job.submit_cmd
+    single = Job(command='true', engine='sge', work_dir=str(tmp_path), name='w')
+    single.submit()
+    assert "-o './w.o$JOB_ID'" in single.submit_cmd
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_console_workers_run_concurrently(tmp_path):
+    # each output line is the ID of the worker that processed the input line
+    cmd = "sh -c 'while read line; do sleep 0.1; echo $QSUBMIT_TASK_ID; done'"
+    env = dict(os.environ, HOME=str(tmp_path), QSUBMIT_CACHE_DIR=str(tmp_path / 'cache'),
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    res = subprocess.run([sys.executable, '-m', 'qsubmit.qruncmd', '--engine', 'console', '--jobs', '3',
+                          '--size', '2', '--workdir', str(tmp_path / 'workdir'), cmd],
+                         input=''.join(f'{i}\n' for i in range(30)), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, encoding='UTF-8', cwd=str(tmp_path), env=env, timeout=120)
+    assert res.returncode == 0, res.stderr
+    workers = res.stdout.split()
+    assert len(workers) == 30
+    assert len(set(workers)) > 1
+
+
+def test_resume_removes_partial_worker_files(tmp_path):
+    from qsubmit.qruncmd import prepare_resume
+    for d in ('pending', 'claimed'):
+        (tmp_path / d).mkdir()
+    (tmp_path / 'claimed' / 'job_1@3').write_text('input')
+    (tmp_path / 'job_1.out@3').write_text('partial')
+    (tmp_path / 'job_2.ok.tmp@4').write_text('')
+    (tmp_path / 'worker-4.alive').write_text('')
+    jobs = {1: {'flushed': False}, 2: {'flushed': False}}
+    assert prepare_resume(str(tmp_path), jobs) == 4
+    assert sorted(os.listdir(tmp_path)) == ['claimed', 'pending', 'worker-4.alive']
+    assert os.listdir(tmp_path / 'pending') == ['job_1']
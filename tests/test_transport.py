@@ -0,0 +1,35 @@
+import socket
+
+import pytest
+
+from qsubmit import transport
+from qsubmit.transport import QruncmdServer
+
+
+@pytest.fixture
+def server():
+    server = QruncmdServer('127.0.0.1', 0)
+    server.start()
+    server.publish(0, b'line\n')
+    yield server
+    server.close()
+
+
+def request_chunk(server, token=None):
+    with socket.create_connection(('127.0.0.1', server.port), timeout=10) as conn:
+        if token is not None:
+            transport.send_frame(conn, transport.AUTH, payload=token.encode())
+        transport.send_frame(conn, transport.REQUEST)
+        return transport.recv_frame(conn)
+
+
+def test_worker_with_token_gets_chunk(server):
+    assert request_chunk(server, server.token) == (transport.CHUNK, 0, b'line\n')
+
+
+@pytest.mark.parametrize('token', [None, 'wrong'])
+def test_worker_without_token_is_rejected(server, token):
+    with pytest.raises(ConnectionError):
+        request_chunk(server, token)
+    # the chunk has not been handed out
+    assert server.queued() == 1
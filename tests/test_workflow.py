@@ -0,0 +1,18 @@
+from qsubmit import Job
+from qsubmit.workflow import Workflow
+
+
+def test_dependents_are_held_until_success(fake_slurm, tmp_path):
+    prep = Job(command='true', engine='slurm', work_dir=str(tmp_path))
+    train = Job(command='true', engine='slurm', work_dir=str(tmp_path))
+    workflow = Workflow()
+    workflow.add(prep)
+    workflow.add(train, after=prep)
+    workflow.submit()
+    assert f'afterok:{prep.jobid}' in train.submit_cmd
+    workflow.wait()
+    assert workflow.summary() == {Workflow.DONE: 2}
+    # the jobs outside of workflows run after their dependencies in any case
+    other = Job(command='true', engine='slurm', work_dir=str(tmp_path), dependencies=[prep])
+    other.submit()
+    assert f'afterany:{prep.jobid}' in other.submit_cmd